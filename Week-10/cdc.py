@@ -0,0 +1,151 @@
+"""
+CDC Module
+Applies changes recorded by the trigger change log (migrations/changelog.sql) to the target
+"""
+import logging
+from collections import defaultdict
+
+from db import connect
+from worker import Worker
+
+CHANGELOG_TABLE = 'changelog'
+POSITION_TABLE = 'cdc_position'
+CDC_BATCH_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_position_table(connection):
+    """Create the target-side table holding the last applied change"""
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {POSITION_TABLE} (
+            source_db TEXT PRIMARY KEY
+            , seq BIGINT NOT NULL
+            , applied_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+    """)
+    connection.commit()
+    cursor.close()
+
+
+def stored_position(cursor, source_db):
+    """Sequence number of the last change applied from source_db, 0 before the first run, for reporting only"""
+    cursor.execute(f"SELECT seq FROM {POSITION_TABLE} WHERE source_db = %s", (source_db,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def save_position(cursor, source_db, seq):
+    """Record the last applied change, committed together with the changes"""
+    cursor.execute(
+        f"INSERT INTO {POSITION_TABLE} (source_db, seq) VALUES (%s, %s) "
+        f"ON CONFLICT (source_db) DO UPDATE SET seq = EXCLUDED.seq, applied_at = now()",
+        (source_db, seq)
+    )
+
+
+def read_changes(cursor, limit):
+    """
+    Oldest unconsumed changes as (seq, table_name, op, row_id). Consumed entries are deleted,
+    so a transaction that committed late with a smaller seq is still picked up. Reading
+    after the stored position instead would skip it, the position only records progress
+    """
+    cursor.execute(
+        f"SELECT seq, table_name, op, row_id FROM {CHANGELOG_TABLE} ORDER BY seq LIMIT %s",
+        (limit,)
+    )
+    return cursor.fetchall()
+
+
+class ChangeApplier:
+    """Applies batches of changes, tables are given parents first"""
+
+    def __init__(self, source_db, target_db, tables, batch_size=CDC_BATCH_SIZE):
+        """Initialize applier"""
+        self.source_db = source_db
+        self.target_db = target_db
+        self.tables = tables
+        self.batch_size = batch_size
+        self.workers = {table_name: Worker('cdc', table_name, source_db, target_db, 'sync') for table_name in tables}
+
+    def apply_batch(self, source_cursor, target_cursor, changes):
+        """
+        Bring every changed row to its current source state. Rows still in the source are
+        upserted parents first, then rows gone from it are deleted children first.
+        Returns (upserted, deleted)
+        """
+        ids = defaultdict(set)
+        for _, table_name, _, row_id in changes:
+            ids[table_name].add(row_id)
+        unknown = set(ids) - set(self.tables)
+        if unknown:
+            raise ValueError(f"Changes for tables that are not transferred: {sorted(unknown)}")
+
+        present = {}
+        for table_name in self.tables:
+            if not ids[table_name]:
+                continue
+            source_cursor.execute(f"SELECT * FROM {table_name} WHERE id = ANY(%s) ORDER BY id", (list(ids[table_name]),))
+            columns = [desc[0] for desc in source_cursor.description]
+            rows = source_cursor.fetchall()
+            present[table_name] = (columns, rows)
+
+        # Upserts first, rows that moved to another parent no longer reference deleted ones
+        upserted = 0
+        for table_name in self.tables:
+            if table_name not in present:
+                continue
+            columns, rows = present[table_name]
+            if rows:
+                worker = self.workers[table_name]
+                worker.create_staging_table(target_cursor)
+                worker.insert_rows(target_cursor, columns, rows, worker.staging_table)
+                upserted += worker.upsert_staged(target_cursor, columns)
+
+        deleted = 0
+        for table_name in reversed(self.tables):
+            if table_name not in present:
+                continue
+            columns, rows = present[table_name]
+            gone = ids[table_name] - {row[0] for row in rows}
+            if gone:
+                target_cursor.execute(f"DELETE FROM {table_name} WHERE id = ANY(%s)", (list(gone),))
+                deleted += target_cursor.rowcount
+        return upserted, deleted
+
+    def run(self):
+        """Apply every change logged so far, one transaction per batch on each side"""
+        source_conn = connect(self.source_db, isolation=True)
+        target_conn = connect(self.target_db)
+        ensure_position_table(target_conn)
+        try:
+            source_cursor = source_conn.cursor()
+            target_cursor = target_conn.cursor()
+            position = stored_position(target_cursor, self.source_db)
+            logger.info(f"Applying logged changes, last applied position {position}")
+            total = 0
+            while True:
+                # Changes and rows are read in one snapshot, so a row's parents are visible too
+                changes = read_changes(source_cursor, self.batch_size)
+                if not changes:
+                    source_conn.commit()
+                    break
+                upserted, deleted = self.apply_batch(source_cursor, target_cursor, changes)
+                position = max(position, changes[-1][0])
+                save_position(target_cursor, self.source_db, position)
+                target_conn.commit()
+
+                # Applying is idempotent, if this fails the batch is simply applied again
+                source_cursor.execute(
+                    f"DELETE FROM {CHANGELOG_TABLE} WHERE seq = ANY(%s)", ([change[0] for change in changes],)
+                )
+                source_conn.commit()
+                total += len(changes)
+                logger.info(f"Applied {len(changes)} changes ({upserted} upserted, {deleted} deleted) "
+                            f"up to position {position}")
+            logger.info(f"Applied {total} changes, position {position}")
+            return total
+        finally:
+            source_conn.close()
+            target_conn.close()
@@ -0,0 +1,83 @@
+"""
+Checkpoints Module
+Durable per-range progress kept in a control table on the target database
+"""
+import logging
+
+CHECKPOINT_TABLE = 'transfer_checkpoints'
+
+logger = logging.getLogger(__name__)
+
+
+def run_key(table_name, mode, where_clause=None):
+    """Identifies a transfer, a later run with the same key resumes it"""
+    return f"{table_name}|{mode}|{where_clause or ''}"
+
+
+def ensure_table(connection):
+    """Create the control table if needed"""
+    cursor = connection.cursor()
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+            run_key TEXT NOT NULL
+            , start_id BIGINT NOT NULL
+            , end_id BIGINT NOT NULL
+            , last_id BIGINT NOT NULL
+            , updated_at TIMESTAMP NOT NULL DEFAULT now()
+            , PRIMARY KEY (run_key, start_id, end_id)
+        )
+    """)
+    connection.commit()
+    cursor.close()
+
+
+def load_ranges(connection, key):
+    """(start_id, end_id, last_id) of every range of an unfinished run, empty for a new run"""
+    cursor = connection.cursor()
+    cursor.execute(
+        f"SELECT start_id, end_id, last_id FROM {CHECKPOINT_TABLE} WHERE run_key = %s ORDER BY start_id",
+        (key,)
+    )
+    ranges = cursor.fetchall()
+    cursor.close()
+    return ranges
+
+
+def save_ranges(connection, key, ranges):
+    """Record the ranges of a new run, nothing of them is done yet"""
+    cursor = connection.cursor()
+    cursor.executemany(
+        f"INSERT INTO {CHECKPOINT_TABLE} (run_key, start_id, end_id, last_id) VALUES (%s, %s, %s, %s) "
+        f"ON CONFLICT DO NOTHING",
+        [(key, start_id, end_id, start_id) for start_id, end_id in ranges]
+    )
+    connection.commit()
+    cursor.close()
+
+
+def committed_id(cursor, key, start_id, end_id):
+    """Last id committed for a range, start_id if nothing was"""
+    cursor.execute(
+        f"SELECT last_id FROM {CHECKPOINT_TABLE} WHERE run_key = %s AND start_id = %s AND end_id = %s",
+        (key, start_id, end_id)
+    )
+    row = cursor.fetchone()
+    return row[0] if row else start_id
+
+
+def advance(cursor, key, start_id, end_id, last_id):
+    """Move a range's checkpoint, must be committed together with the batch it describes"""
+    cursor.execute(
+        f"UPDATE {CHECKPOINT_TABLE} SET last_id = %s, updated_at = now() "
+        f"WHERE run_key = %s AND start_id = %s AND end_id = %s",
+        (last_id, key, start_id, end_id)
+    )
+
+
+def clear(connection, key):
+    """Forget a finished run"""
+    cursor = connection.cursor()
+    cursor.execute(f"DELETE FROM {CHECKPOINT_TABLE} WHERE run_key = %s", (key,))
+    connection.commit()
+    cursor.close()
+    logger.info(f"Cleared checkpoints of {key}")
@@ -0,0 +1,128 @@
+"""
+Copy Stream Module
+Streams COPY TO STDOUT of the source into COPY FROM STDIN of the target
+"""
+import logging
+import queue
+import threading
+
+# binary COPY needs identical column types on both sides, 'text' works across versions
+COPY_FORMAT = 'binary'
+CHUNK_BYTES = 256 * 1024
+# chunks waiting between the two connections, bounds memory to about 4 MB per worker
+MAX_CHUNKS = 16
+PUT_TIMEOUT = 1  # seconds
+
+logger = logging.getLogger(__name__)
+
+
+class PipeClosed(Exception):
+    """Raised in the source thread when the target side stopped reading"""
+
+
+class CopyPipe:
+    """Bounded file-like bridge, written by COPY TO and read by COPY FROM"""
+
+    def __init__(self, max_chunks=MAX_CHUNKS, chunk_bytes=CHUNK_BYTES):
+        self._chunks = queue.Queue(max_chunks)
+        self._chunk_bytes = chunk_bytes
+        self._pending = bytearray()
+        self._current = memoryview(b"")
+        self._finished = False
+        self.closed = False
+
+    def write(self, data):
+        """Called by the source cursor, once per COPY message"""
+        self._pending += data
+        if len(self._pending) >= self._chunk_bytes:
+            self._put(bytes(self._pending))
+            self._pending.clear()
+        return len(data)
+
+    def finish(self):
+        """Flush and mark the end of the stream"""
+        if self._pending:
+            self._put(bytes(self._pending))
+            self._pending.clear()
+        self._put(None)
+
+    def _put(self, chunk):
+        while True:
+            if self.closed:
+                raise PipeClosed()
+            try:
+                self._chunks.put(chunk, timeout=PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def read(self, size=-1):
+        """Called by the target cursor, b'' ends the COPY"""
+        if not self._current:
+            if self._finished:
+                return b""
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._finished = True
+                return b""
+            self._current = memoryview(chunk)
+        if size is None or size < 0:
+            size = len(self._current)
+        data = self._current[:size]
+        self._current = self._current[size:]
+        return bytes(data)
+
+    def abort(self):
+        """End the stream early, for when the source side failed"""
+        self.closed = True
+        self._chunks.put(None)
+
+    def close(self):
+        """Stop the writer, for when the target side failed"""
+        self.closed = True
+        while True:
+            try:
+                self._chunks.get_nowait()
+            except queue.Empty:
+                return
+
+
+def stream_copy(source_cursor, target_cursor, table_name, columns, conditions, params, target_table=None):
+    """
+    Copy rows matching conditions from source to target (or target_table there)
+    without building Python rows, returns the number of rows copied
+    """
+    columns_str = ', '.join(columns)
+    select = source_cursor.mogrify(
+        f"SELECT {columns_str} FROM {table_name} WHERE {' AND '.join(conditions)} ORDER BY id",
+        params
+    ).decode('utf-8')
+    copy_out = f"COPY ({select}) TO STDOUT (FORMAT {COPY_FORMAT})"
+    copy_in = f"COPY {target_table or table_name} ({columns_str}) FROM STDIN (FORMAT {COPY_FORMAT})"
+
+    pipe = CopyPipe()
+    errors = []
+
+    def produce():
+        try:
+            source_cursor.copy_expert(copy_out, pipe)
+            pipe.finish()
+        except PipeClosed:
+            pass
+        except Exception as e:
+            errors.append(e)
+            # the reader ends its COPY, the caller must not commit it
+            pipe.abort()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        target_cursor.copy_expert(copy_in, pipe)
+    except Exception:
+        pipe.close()
+        raise
+    finally:
+        producer.join()
+    if errors:
+        raise errors[0]
+    return target_cursor.rowcount
@@ -0,0 +1,36 @@
+-- Change log for `transfer.py --mode cdc`, run on the source database
+
+CREATE TABLE IF NOT EXISTS changelog (
+    seq BIGSERIAL PRIMARY KEY
+    , table_name TEXT NOT NULL
+    , op CHAR(1) NOT NULL
+    , row_id INT NOT NULL
+    , changed_at TIMESTAMP NOT NULL DEFAULT clock_timestamp()
+);
+
+CREATE OR REPLACE FUNCTION log_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        INSERT INTO changelog (table_name, op, row_id) VALUES (TG_TABLE_NAME, 'D', OLD.id);
+        RETURN OLD;
+    END IF;
+    -- an update of the id removes the row under its old id
+    IF TG_OP = 'UPDATE' AND NEW.id IS DISTINCT FROM OLD.id THEN
+        INSERT INTO changelog (table_name, op, row_id) VALUES (TG_TABLE_NAME, 'D', OLD.id);
+    END IF;
+    INSERT INTO changelog (table_name, op, row_id) VALUES (TG_TABLE_NAME, left(TG_OP, 1), NEW.id);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_changelog ON users;
+CREATE TRIGGER users_changelog AFTER INSERT OR UPDATE OR DELETE ON users
+    FOR EACH ROW EXECUTE FUNCTION log_change();
+
+DROP TRIGGER IF EXISTS products_changelog ON products;
+CREATE TRIGGER products_changelog AFTER INSERT OR UPDATE OR DELETE ON products
+    FOR EACH ROW EXECUTE FUNCTION log_change();
+
+DROP TRIGGER IF EXISTS recommendations_changelog ON recommendations;
+CREATE TRIGGER recommendations_changelog AFTER INSERT OR UPDATE OR DELETE ON recommendations
+    FOR EACH ROW EXECUTE FUNCTION log_change();
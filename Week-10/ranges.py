@@ -0,0 +1,59 @@
+"""
+Ranges Module
+Splits tables into id ranges for the workers
+"""
+import logging
+
+# about this many ids are sampled to find range boundaries of big tables
+QUANTILE_SAMPLE_ROWS = 200000
+
+logger = logging.getLogger(__name__)
+
+
+def id_bounds(cursor, table_name, where_clause=None):
+    """Smallest and largest id, (None, None) for no rows"""
+    query = f"SELECT min(id), max(id) FROM {table_name}"
+    if where_clause:
+        query += f" WHERE {where_clause}"
+    cursor.execute(query)
+    return cursor.fetchone()
+
+
+def sampled_boundaries(cursor, table_name, parts, total_rows, where_clause=None):
+    """Ids splitting the rows into parts of about equal size, from a sample of big tables"""
+    fractions = [i / parts for i in range(1, parts)]
+    query = f"SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY id) FROM {table_name}"
+    percent = 100.0 * QUANTILE_SAMPLE_ROWS / max(total_rows, 1)
+    if percent < 100:
+        query += f" TABLESAMPLE SYSTEM ({percent:.4f})"
+    if where_clause:
+        query += f" WHERE {where_clause}"
+    cursor.execute(query, (fractions,))
+    result = cursor.fetchone()[0]
+    return [boundary for boundary in result or [] if boundary is not None]
+
+
+def id_ranges(connection, table_name, parts, total_rows, where_clause=None):
+    """
+    Split the table into at most parts ranges (after_id, last_id],
+    by row quantiles so skewed ids still give ranges of similar size
+    """
+    cursor = connection.cursor()
+    try:
+        low, high = id_bounds(cursor, table_name, where_clause)
+        if low is None:
+            return []
+        boundaries = []
+        if parts > 1:
+            boundaries = sampled_boundaries(cursor, table_name, parts, total_rows, where_clause)
+        if not boundaries:
+            # empty sample, fall back to equal id widths
+            width = (high - low + 1) / parts
+            boundaries = [low - 1 + round(i * width) for i in range(1, parts)]
+    finally:
+        cursor.close()
+
+    edges = [low - 1] + sorted({b for b in boundaries if low <= b < high}) + [high]
+    ranges = list(zip(edges, edges[1:]))
+    logger.info(f"Split {table_name} into {len(ranges)} id ranges between {low} and {high}")
+    return ranges
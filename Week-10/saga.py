@@ -2,31 +2,48 @@
 Saga Module
 Implements Saga pattern to manage worker processes
 """
+import heapq
 import logging
+import queue
 import time
+from collections import namedtuple
+from contextlib import nullcontext
 from multiprocessing import Pool
-import sys
 
 logger = logging.getLogger(__name__)
 
+
+class RetryPolicy(namedtuple('RetryPolicy', ['max_attempts', 'backoff', 'max_backoff', 'interactive'])):
+    """How often and how soon failed chunks run again"""
+
+    def delay(self, attempt):
+        """Seconds to wait before the attempt after the given one"""
+        return min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+
+
+DEFAULT_POLICY = RetryPolicy(max_attempts=3, backoff=5, max_backoff=300, interactive=False)
+
+
 class Saga:
-    """Implements Saga pattern, allows restarting failed workers"""
+    """Implements Saga pattern, runs chunks of a table and restarts failed ones"""
     
-    def __init__(self, table_name, worker_args):
-        """Initialize saga coordinator"""
+    def __init__(self, table_name, worker_args, num_workers=None, policy=DEFAULT_POLICY, pool=None):
+        """Initialize saga coordinator, chunks run on pool if given, shared with other sagas"""
         self.table_name = table_name
         self.worker_args = worker_args
-        self.num_workers = len(worker_args)
+        self.num_workers = num_workers or len(worker_args)
+        self.policy = policy
+        self.pool = pool
         self.failed_workers = []
     
     def ask_for_retry(self):
-        """Ask if user wants to retry failed workers"""
+        """Ask if user wants to retry failed chunks, only with --interactive"""
         worker_ids = [self.worker_args[i][0] for i in self.failed_workers]
         
         while True:
-            print(f"\nThe following workers failed: {worker_ids}")
+            print(f"\nThe following chunks failed: {worker_ids}")
             print(f"for table {self.table_name}")
-            print("Do you want to retry these workers? (y/n): ", end='')
+            print("Do you want to retry these chunks? (y/n): ", end='')
             
             try:
                 answer = input().lower().strip()
@@ -41,36 +58,72 @@ class Saga:
                 return False
 
     def execute(self, worker_function):
-        """Execute all workers and manage any failures"""
-        max_attempts = 3
-        attempt = 1
-        
-        while attempt <= max_attempts:
-            logger.info(f"Saga attempt {attempt}/{max_attempts} for table {self.table_name}")
-            
-            # Run all workers in parallel
-            with Pool(processes=self.num_workers) as pool:
-                results = pool.map(worker_function, self.worker_args)
-            
-            # Check for failures
-            self.failed_workers = [i for i, success in enumerate(results) if not success]
-            
-            if not self.failed_workers:
-                logger.info(f"All workers completed successfully for table {self.table_name}")
-                return True
+        """
+        Run every chunk on a pool of num_workers processes (or the shared pool), idle processes take the next
+        chunk from the shared queue. Failed chunks are requeued after a backoff until
+        policy.max_attempts, then the operator is asked only if policy.interactive
+        """
+        attempts = {i: 0 for i in range(len(self.worker_args))}
+        results = queue.Queue()
+        # (time to resubmit, chunk index)
+        delayed = []
 
-            # Retry failed workers
-            if attempt < max_attempts:
-                should_retry = self.ask_for_retry()
-                if not should_retry:
-                    logger.info("User chose not to retry failed workers")
-                    return False
-                    
-                # Update worker args to include only failed workers
-                self.worker_args = [self.worker_args[i] for i in self.failed_workers]
-                self.num_workers = len(self.worker_args)
-                
-            attempt += 1
-            
-        logger.error(f"Failed to complete all workers for table {self.table_name} after {max_attempts} attempts")
-        return False
\ No newline at end of file
+        if self.pool is not None:
+            pool_context = nullcontext(self.pool)
+        else:
+            pool_context = Pool(processes=max(1, min(self.num_workers, len(self.worker_args))))
+        with pool_context as pool:
+            def submit(i):
+                attempts[i] += 1
+                pool.apply_async(
+                    worker_function, (self.worker_args[i],),
+                    callback=lambda success, i=i: results.put((i, success)),
+                    error_callback=lambda error, i=i: results.put((i, False))
+                )
+
+            for i in attempts:
+                submit(i)
+            outstanding = len(attempts)
+
+            while outstanding or delayed:
+                now = time.monotonic()
+                while delayed and delayed[0][0] <= now:
+                    _, i = heapq.heappop(delayed)
+                    logger.info(f"Requeueing chunk {self.worker_args[i][0]} of {self.table_name} "
+                                f"(attempt {attempts[i] + 1}/{self.policy.max_attempts})")
+                    submit(i)
+                    outstanding += 1
+                if not outstanding:
+                    time.sleep(max(0, delayed[0][0] - time.monotonic()))
+                    continue
+
+                try:
+                    # wake up for the next requeue even if no chunk finishes before it
+                    i, success = results.get(timeout=max(0, delayed[0][0] - now) if delayed else None)
+                except queue.Empty:
+                    continue
+                outstanding -= 1
+                if success:
+                    continue
+                if attempts[i] < self.policy.max_attempts:
+                    heapq.heappush(delayed, (time.monotonic() + self.policy.delay(attempts[i]), i))
+                    continue
+
+                self.failed_workers.append(i)
+                if outstanding or delayed:
+                    continue
+                # Nothing else is running, only the exhausted chunks are left
+                if not self.policy.interactive or not self.ask_for_retry():
+                    break
+                for i in self.failed_workers:
+                    attempts[i] = 0
+                    submit(i)
+                outstanding = len(self.failed_workers)
+                self.failed_workers = []
+
+        if self.failed_workers:
+            logger.error(f"Failed to complete chunks {[self.worker_args[i][0] for i in self.failed_workers]} "
+                         f"for table {self.table_name} after {self.policy.max_attempts} attempts")
+            return False
+        logger.info(f"All chunks completed successfully for table {self.table_name}")
+        return True
@@ -0,0 +1,94 @@
+"""
+Scheduler Module
+Discovers tables and their foreign keys, runs them as a dependency graph
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+
+def discover_tables(connection, exclude=()):
+    """{table: set of tables it references} for every table of the public schema"""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("""
+            SELECT c.relname
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p') AND NOT c.relispartition
+        """)
+        graph = {name: set() for (name,) in cursor.fetchall() if name not in exclude}
+        cursor.execute("""
+            SELECT child.relname, parent.relname
+            FROM pg_constraint fk
+            JOIN pg_class child ON child.oid = fk.conrelid
+            JOIN pg_class parent ON parent.oid = fk.confrelid
+            JOIN pg_namespace n ON n.oid = fk.connamespace
+            WHERE fk.contype = 'f' AND n.nspname = 'public'
+        """)
+        for child, parent in cursor.fetchall():
+            # self references do not order tables
+            if child in graph and parent in graph and child != parent:
+                graph[child].add(parent)
+        return graph
+    finally:
+        cursor.close()
+
+
+def topological_order(graph):
+    """Tables with parents before children, raises ValueError on a reference cycle"""
+    remaining = {table: set(parents) for table, parents in graph.items()}
+    order = []
+    while remaining:
+        ready = sorted(table for table, parents in remaining.items() if not parents)
+        if not ready:
+            raise ValueError(f"Foreign key cycle between {sorted(remaining)}")
+        for table in ready:
+            del remaining[table]
+        for parents in remaining.values():
+            parents.difference_update(ready)
+        order.extend(ready)
+    return order
+
+
+def run_graph(graph, run_table):
+    """
+    Call run_table(table) for every table as soon as all tables it references succeeded,
+    independent tables run concurrently. Returns True if every table succeeded
+    """
+    topological_order(graph)  # fail early on cycles
+    done = set()
+    failed = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, len(graph))) as executor:
+        def start_ready():
+            for table, parents in graph.items():
+                if table not in done and table not in failed and table not in running.values() \
+                        and parents <= done:
+                    logger.info(f"Starting table {table}")
+                    running[executor.submit(run_table, table)] = table
+
+        start_ready()
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                table = running.pop(future)
+                try:
+                    success = future.result()
+                except Exception as e:
+                    logger.error(f"Table {table} failed: {e}")
+                    success = False
+                if success:
+                    done.add(table)
+                else:
+                    failed.add(table)
+            if not failed:
+                start_ready()
+
+    skipped = set(graph) - done - failed
+    if failed or skipped:
+        logger.error(f"Failed tables: {sorted(failed)}, not started: {sorted(skipped)}")
+        return False
+    return True
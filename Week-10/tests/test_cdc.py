@@ -0,0 +1,118 @@
+"""
+CDC Tests
+Applies change batches against in-memory databases that enforce foreign keys
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cdc import ChangeApplier
+from worker import Worker
+
+TABLES = ['users', 'recommendations']
+COLUMNS = {'users': ['id', 'name'], 'recommendations': ['id', 'user_id']}
+# child table -> (column, parent table)
+FOREIGN_KEYS = {'recommendations': ('user_id', 'users')}
+
+
+class ForeignKeyViolation(Exception):
+    """Raised by the fake target like postgres would"""
+
+
+class SourceCursor:
+    """Answers the applier's SELECT ... WHERE id = ANY(%s)"""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.description = None
+        self.rows = []
+
+    def execute(self, query, params):
+        table_name = query.split(" FROM ")[1].split()[0]
+        self.description = [(column,) for column in COLUMNS[table_name]]
+        self.rows = sorted(row for row_id, row in self.tables[table_name].items() if row_id in params[0])
+
+    def fetchall(self):
+        return self.rows
+
+
+class TargetCursor:
+    """Applies DELETE ... WHERE id = ANY(%s) and staged upserts, checking foreign keys after every statement"""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.staged = {}
+        self.rowcount = 0
+
+    def execute(self, query, params=None):
+        assert query.startswith("DELETE FROM "), query
+        table_name = query.split()[2]
+        self.rowcount = sum(self.tables[table_name].pop(row_id, None) is not None for row_id in params[0])
+        self.check()
+
+    def check(self):
+        for child, (column, parent) in FOREIGN_KEYS.items():
+            index = COLUMNS[child].index(column)
+            for row in self.tables[child].values():
+                if row[index] not in self.tables[parent]:
+                    raise ForeignKeyViolation(f"{child} row {row[0]} references missing {parent} {row[index]}")
+
+
+@pytest.fixture
+def staging(monkeypatch):
+    """Worker staging goes to the fake target cursor instead of SQL"""
+    def create_staging_table(self, cursor):
+        cursor.staged[self.table_name] = []
+
+    def insert_rows(self, cursor, columns, rows, table_name=None):
+        cursor.staged[self.table_name].extend(rows)
+        return len(rows)
+
+    def upsert_staged(self, cursor, columns):
+        rows = cursor.staged.pop(self.table_name)
+        for row in rows:
+            cursor.tables[self.table_name][row[0]] = tuple(row)
+        cursor.check()
+        return len(rows)
+
+    monkeypatch.setattr(Worker, 'create_staging_table', create_staging_table)
+    monkeypatch.setattr(Worker, 'insert_rows', insert_rows)
+    monkeypatch.setattr(Worker, 'upsert_staged', upsert_staged)
+
+
+def test_reparent_then_delete_parent(staging):
+    """A child moved to another parent in the same batch that deletes its old parent"""
+    source = {'users': {2: (2, 'b')}, 'recommendations': {10: (10, 2)}}
+    target = {'users': {1: (1, 'a'), 2: (2, 'b')}, 'recommendations': {10: (10, 1)}}
+    changes = [(1, 'recommendations', 'U', 10), (2, 'users', 'D', 1)]
+
+    applier = ChangeApplier('source', 'target', TABLES)
+    upserted, deleted = applier.apply_batch(SourceCursor(source), TargetCursor(target), changes)
+
+    assert (upserted, deleted) == (1, 1)
+    assert target == source
+
+
+def test_delete_child_and_parent(staging):
+    """Children are deleted before the parent they reference"""
+    source = {'users': {}, 'recommendations': {}}
+    target = {'users': {1: (1, 'a')}, 'recommendations': {10: (10, 1)}}
+    changes = [(1, 'users', 'D', 1), (2, 'recommendations', 'D', 10)]
+
+    applier = ChangeApplier('source', 'target', TABLES)
+    assert applier.apply_batch(SourceCursor(source), TargetCursor(target), changes) == (0, 2)
+    assert target == source
+
+
+def test_insert_parent_and_child(staging):
+    """Parents are upserted before the children referencing them"""
+    source = {'users': {3: (3, 'c')}, 'recommendations': {11: (11, 3)}}
+    target = {'users': {}, 'recommendations': {}}
+    changes = [(1, 'recommendations', 'I', 11), (2, 'users', 'I', 3)]
+
+    applier = ChangeApplier('source', 'target', TABLES)
+    assert applier.apply_batch(SourceCursor(source), TargetCursor(target), changes) == (2, 0)
+    assert target == source
@@ -8,15 +8,22 @@ import logging
 from datetime import datetime
 import os
 import time
-from multiprocessing import Pool, Manager
+from multiprocessing import Pool
 
+import checkpoints
+from cdc import ChangeApplier, CHANGELOG_TABLE, POSITION_TABLE
 from db import connect
+from ranges import id_ranges
+from scheduler import discover_tables, topological_order, run_graph
 from worker import Worker
 from validation import Validator
-from saga import Saga
+from saga import Saga, RetryPolicy, DEFAULT_POLICY
 
 
-TABLES = ['users', 'products', 'recommendations']
+# bookkeeping tables, never transferred
+CONTROL_TABLES = (CHANGELOG_TABLE, POSITION_TABLE, checkpoints.CHECKPOINT_TABLE)
+# rows per chunk, tables get many more chunks than workers so idle workers can take the next one
+CHUNK_ROWS = 50000
 
 # Setup logging
 logging.basicConfig(
@@ -42,6 +49,29 @@ def count_rows(connection, table_name, where_clause=None):
     return count
 
 
+def count_pending_rows(connection, table_name, ranges, where_clause=None):
+    """Number of rows in (after_id, last_id] ranges"""
+    if not ranges:
+        return 0
+    cursor = connection.cursor()
+    query = (
+        f"SELECT COUNT(*) FROM {table_name} "
+        f"JOIN unnest(%s::bigint[], %s::bigint[]) AS pending(after_id, last_id) "
+        f"ON id > pending.after_id AND id <= pending.last_id"
+    )
+    if where_clause:
+        query += f" WHERE ({where_clause})"
+    cursor.execute(query, ([after_id for after_id, _ in ranges], [last_id for _, last_id in ranges]))
+    count = cursor.fetchone()[0]
+    cursor.close()
+    return count
+
+
+def unfinished_ranges(saved_ranges):
+    """(last committed id, end id) of every range of a run that is not done yet"""
+    return [(last_id, end_id) for start_id, end_id, last_id in saved_ranges if last_id < end_id]
+
+
 def get_last_sync_time():
     """Get last sync time from file"""
     try:
@@ -64,6 +94,15 @@ def save_sync_time(sync_time):
         raise e
 
 
+def table_graph(source_db):
+    """{table: tables it references} of the source database"""
+    connection = connect(source_db)
+    try:
+        return discover_tables(connection, CONTROL_TABLES)
+    finally:
+        connection.close()
+
+
 def clear_table(connection, table_name):
     """Clear table"""
     cursor = connection.cursor()
@@ -75,19 +114,28 @@ def clear_table(connection, table_name):
 
 def worker_process(args):
     """Function that will be EXECUTED in worker process"""
-    worker_id, table_name, start_id, end_id, source_db, target_db, mode, where_clause, retry_state = args
-    worker = Worker(worker_id, table_name, source_db, target_db, mode)
-    return worker.process(start_id, end_id, where_clause, retry_state)
+    worker_id, table_name, start_id, end_id, source_db, target_db, mode, where_clause, engine, run_key = args
+    worker = Worker(worker_id, table_name, source_db, target_db, mode, engine, run_key)
+    return worker.process(start_id, end_id, where_clause)
 
 
-def transfer_table(table_name, source_db, target_db, num_workers, mode, where_clause=None):
-    """Transfer a single table using multiple workers"""
+def transfer_table(table_name, source_db, target_db, num_workers, mode, where_clause=None, engine='insert',
+                   policy=DEFAULT_POLICY, repair=False, pool=None, clear_checkpoints=True):
+    """
+    Transfer a single table using multiple workers, resumes an unfinished run of the same transfer.
+    Chunks and validation queries run on pool if given, checkpoints are kept on success unless clear_checkpoints
+    """
     source_conn = connect(source_db, isolation=True)
     target_conn = connect(target_db)
     
-    # In copy mode clear target table
-    if mode == 'copy':
-        clear_table(target_conn, table_name)
+    checkpoints.ensure_table(target_conn)
+    run_key = checkpoints.run_key(table_name, mode, where_clause)
+    saved_ranges = checkpoints.load_ranges(target_conn, run_key)
+    
+    # In copy mode the caller cleared the target table, unless resuming
+    if saved_ranges:
+        logger.info(f"Resuming {table_name}: {sum(1 for start_id, end_id, last_id in saved_ranges if last_id < end_id)} "
+                    f"of {len(saved_ranges)} ranges unfinished")
     
     # Count rows
     total_rows = count_rows(source_conn, table_name, where_clause)
@@ -95,54 +143,120 @@ def transfer_table(table_name, source_db, target_db, num_workers, mode, where_cl
     
     if total_rows == 0:
         logger.info(f"No rows to process for {table_name}")
+        if clear_checkpoints:
+            checkpoints.clear(target_conn, run_key)
         source_conn.close()
         target_conn.close()
         return True
     
-    # Calculate ranges for each worker
-    rows_per_worker = max(1, total_rows // num_workers)
+    if saved_ranges:
+        # Same ranges as the interrupted run, the checkpoints refer to them
+        ranges = [(start_id, end_id) for start_id, end_id, last_id in saved_ranges if last_id < end_id]
+        pending_rows = count_pending_rows(source_conn, table_name, unfinished_ranges(saved_ranges), where_clause)
+    else:
+        # Split ids into many chunks of about equal row counts, workers pull them from a shared queue
+        num_chunks = max(num_workers, -(-total_rows // CHUNK_ROWS))
+        ranges = id_ranges(source_conn, table_name, num_chunks, total_rows, where_clause)
+        checkpoints.save_ranges(target_conn, run_key, ranges)
+        pending_rows = total_rows
     
-    # Create manager to share state between processes
-    manager = Manager()
-    retry_state = manager.dict()
+    # Only the workers hold connections while the chunks run
+    source_conn.close()
+    target_conn.close()
     
     # Prepare arguments for each worker
     worker_args = []
-    for i in range(num_workers):
-        start_id = i * rows_per_worker
-        end_id = total_rows if i == num_workers - 1 else (i + 1) * rows_per_worker
-        worker_args.append((i, table_name, start_id, end_id, source_db, target_db, mode, where_clause, retry_state))
-    
-    # Initialize Saga coordinator
-    saga = Saga(table_name, worker_args)
+    for i, (start_id, end_id) in enumerate(ranges):
+        worker_args.append((i, table_name, start_id, end_id, source_db, target_db, mode, where_clause, engine, run_key))
     
     # Start workers with process pool
-    success = saga.execute(worker_process)
+    started = time.perf_counter()
+    if worker_args:
+        # Initialize Saga coordinator
+        saga = Saga(table_name, worker_args, num_workers, policy, pool)
+        success = saga.execute(worker_process)
+    else:
+        success = True
+    elapsed = time.perf_counter() - started
     
-    source_conn.close()
-    target_conn.close()
+    # Rows copied by this run, not the ones earlier runs already committed
+    copied_rows = pending_rows
+    if not success:
+        source_conn = connect(source_db)
+        target_conn = connect(target_db)
+        left = unfinished_ranges(checkpoints.load_ranges(target_conn, run_key))
+        copied_rows = max(0, pending_rows - count_pending_rows(source_conn, table_name, left, where_clause))
+        source_conn.close()
+        target_conn.close()
+    logger.info(f"{table_name} ({mode}, engine {engine}): {copied_rows} of {total_rows} rows copied in {elapsed:.1f}s, "
+                f"{copied_rows / max(elapsed, 1e-9):.0f} rows/s")
+    
+    # Finished runs start over next time, failed ones resume
+    if success and clear_checkpoints:
+        target_conn = connect(target_db)
+        checkpoints.clear(target_conn, run_key)
+        target_conn.close()
     
     # Validate transfer
     if success:
-        validator = Validator(source_db, target_db)
-        if not validator.validate_table(table_name, where_clause):
+        validator = Validator(source_db, target_db, num_workers, pool=pool)
+        if not validator.validate_table(table_name, where_clause, repair):
             logger.error(f"Data validation failed for {table_name}")
             return False
     return success
 
 
-def transfer_all(source_db, target_db, num_workers):
+def run_tables(graph, source_db, target_db, num_workers, mode, where_clause=None, engine='insert',
+               policy=DEFAULT_POLICY, repair=False):
+    """
+    Transfer every table of graph, a table starts as soon as the tables it references are done.
+    All tables share one pool of num_workers processes for chunks and validation. Checkpoints are cleared only when
+    every table succeeded, so a failed run resumes where each table stopped
+    """
+    keys = [checkpoints.run_key(table_name, mode, where_clause) for table_name in graph]
+    started = time.perf_counter()
+    with Pool(processes=max(1, num_workers)) as pool:
+        success = run_graph(graph, lambda table_name: transfer_table(
+            table_name, source_db, target_db, num_workers, mode, where_clause, engine, policy, repair,
+            pool, clear_checkpoints=False
+        ))
+    elapsed = time.perf_counter() - started
+    logger.info(f"{mode} of {len(graph)} tables {'finished' if success else 'failed'} in {elapsed:.1f}s wall-clock")
+
+    if success:
+        target_conn = connect(target_db)
+        try:
+            for key in keys:
+                checkpoints.clear(target_conn, key)
+        finally:
+            target_conn.close()
+    return success
+
+
+def transfer_all(source_db, target_db, num_workers, engine='insert', policy=DEFAULT_POLICY, repair=False):
     """Copy all tables"""
     try:
         # Save current time as last sync time
         current_time = datetime.now()
         
-        for table_name in TABLES:
-            logger.info(f"Starting full transfer of table {table_name}")
-            if not transfer_table(table_name, source_db, target_db, num_workers, 'copy'):
-                logger.error(f"Transfer failed for table {table_name}")
-                return False
-            logger.info(f"Completed full transfer of table {table_name}")
+        graph = table_graph(source_db)
+        logger.info(f"Starting full transfer of {len(graph)} tables: "
+                    + ', '.join(f"{t} (after {', '.join(sorted(p))})" if p else t for t, p in graph.items()))
+        
+        # Clear target tables that are not being resumed, children before the tables they reference
+        target_conn = connect(target_db)
+        try:
+            checkpoints.ensure_table(target_conn)
+            for table_name in reversed(topological_order(graph)):
+                if not checkpoints.load_ranges(target_conn, checkpoints.run_key(table_name, 'copy')):
+                    clear_table(target_conn, table_name)
+        finally:
+            target_conn.close()
+        
+        if not run_tables(graph, source_db, target_db, num_workers, 'copy', engine=engine, policy=policy,
+                          repair=repair):
+            logger.error("Transfer failed")
+            return False
         
         save_sync_time(current_time)
         logger.info("Transferred all tables successfully!")
@@ -153,7 +267,7 @@ def transfer_all(source_db, target_db, num_workers):
         return False
 
 
-def transfer_updates(source_db, target_db, num_workers):
+def transfer_updates(source_db, target_db, num_workers, engine='insert', policy=DEFAULT_POLICY, repair=False):
     """Update tables"""
     try:
         # Get the last sync time
@@ -163,22 +277,12 @@ def transfer_updates(source_db, target_db, num_workers):
         # Save current time as last sync time
         current_time = datetime.now()
         
-        for table_name in TABLES:
-            # Insert new rows
-            logger.info(f"Starting insertion of new rows for table {table_name}")
-            insert_where = f"created_at >= '{last_sync_time}'"
-            if not transfer_table(table_name, source_db, target_db, num_workers, 'sync', insert_where):
-                logger.error(f"Insert failed for table {table_name}")
-                return False
-            
-            # Update modified rows
-            logger.info(f"Starting update of modified rows for table {table_name}")
-            update_where = f"updated_at >= '{last_sync_time}' AND created_at < '{last_sync_time}'"
-            if not transfer_table(table_name, source_db, target_db, num_workers, 'update', update_where):
-                logger.error(f"Update failed for table {table_name}")
-                return False
-                
-            logger.info(f"Completed updates for table {table_name}")
+        # New and modified rows in one pass, upserted through a staging table
+        sync_where = f"created_at >= '{last_sync_time}' OR updated_at >= '{last_sync_time}'"
+        if not run_tables(table_graph(source_db), source_db, target_db, num_workers, 'sync', sync_where, engine,
+                          policy, repair):
+            logger.error("Sync failed")
+            return False
         
         save_sync_time(current_time)
         logger.info("Synced all updates successfully!")
@@ -189,16 +293,51 @@ def transfer_updates(source_db, target_db, num_workers):
         return False
 
 
+def transfer_changes(source_db, target_db):
+    """Apply inserts, updates and deletes from the source change log"""
+    try:
+        tables = topological_order(table_graph(source_db))
+        ChangeApplier(source_db, target_db, tables).run()
+        logger.info("Applied all changes successfully!")
+        return True
+    except Exception as e:
+        logger.error(f"Error during cdc: {e}")
+        return False
+
+
+def validate_all(source_db, target_db, num_workers, repair=False):
+    """Compare every table, optionally repairing the ranges that differ"""
+    validator = Validator(source_db, target_db, num_workers)
+    tables = topological_order(table_graph(source_db))
+    results = [validator.validate_table(table_name, repair=repair) for table_name in tables]
+    return all(results)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--mode', choices=['copy', 'sync'], required=True)
+    parser.add_argument('--mode', choices=['copy', 'sync', 'cdc', 'validate'], required=True)
     parser.add_argument('--source', required=True)
     parser.add_argument('--target', required=True)
     parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--engine', choices=['insert', 'copy'], default='insert',
+                        help="copy streams COPY TO STDOUT into COPY FROM STDIN")
+    parser.add_argument('--max-attempts', type=int, default=DEFAULT_POLICY.max_attempts,
+                        help="runs of a failing chunk before giving up")
+    parser.add_argument('--retry-backoff', type=float, default=DEFAULT_POLICY.backoff,
+                        help="seconds before the first requeue, doubled for every further one")
+    parser.add_argument('--interactive', action='store_true',
+                        help="ask whether to retry chunks that used up their attempts")
+    parser.add_argument('--repair', action='store_true',
+                        help="transfer id ranges that fail validation again")
     
     args = parser.parse_args()
+    policy = RetryPolicy(args.max_attempts, args.retry_backoff, DEFAULT_POLICY.max_backoff, args.interactive)
     
     if args.mode == 'copy':
-        transfer_all(args.source, args.target, args.workers)
+        transfer_all(args.source, args.target, args.workers, args.engine, policy, args.repair)
+    elif args.mode == 'sync':
+        transfer_updates(args.source, args.target, args.workers, args.engine, policy, args.repair)
+    elif args.mode == 'cdc':
+        transfer_changes(args.source, args.target)
     else:
-        transfer_updates(args.source, args.target, args.workers)
\ No newline at end of file
+        validate_all(args.source, args.target, args.workers, args.repair)
\ No newline at end of file
@@ -2,98 +2,191 @@
 Validator Module
 To ensure all data was moved correctly and completely
 """
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
 from db import connect
+from ranges import id_bounds
+from worker import Worker
+
+VALIDATION_BUCKET_ROWS = 10000  # ids per leaf of the digest tree
+DEFAULT_VALIDATION_WORKERS = 4
 
 logger = logging.getLogger(__name__)
 
+
+def merkle_tree(leaves):
+    """Levels of a binary digest tree, leaves first and the root last"""
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([
+            hashlib.md5(''.join(d or '-' for d in level[i:i + 2]).encode()).hexdigest()
+            for i in range(0, len(level), 2)
+        ])
+    return levels
+
+
+def differing_leaves(source_levels, target_levels):
+    """Indexes of leaves that differ, only descending into subtrees whose digests differ"""
+    if source_levels[-1] == target_levels[-1]:
+        return []
+    nodes = [0]
+    for depth in range(len(source_levels) - 1, 0, -1):
+        nodes = [
+            child for node in nodes for child in (2 * node, 2 * node + 1)
+            if child < len(source_levels[depth - 1])
+            and source_levels[depth - 1][child] != target_levels[depth - 1][child]
+        ]
+    return nodes
+
+
+def table_columns(conn, table_name):
+    """Column names"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT * FROM {table_name} LIMIT 0")
+        return [desc[0] for desc in cursor.description]
+    finally:
+        cursor.close()
+
+
+def db_bounds(db_name, table_name, where_clause=None):
+    """Smallest and largest id in one database"""
+    conn = connect(db_name)
+    try:
+        cursor = conn.cursor()
+        return id_bounds(cursor, table_name, where_clause)
+    finally:
+        conn.close()
+
+
+def bucket_digests(db_name, table_name, bucket_size, first_bucket, last_bucket, where_clause=None):
+    """{bucket: md5 of its rows in id order} for buckets first_bucket..last_bucket of one database"""
+    conn = connect(db_name)
+    cursor = conn.cursor()
+    try:
+        columns_str = ', '.join(table_columns(conn, table_name))
+        query = f"""
+        SELECT id / %s AS bucket, md5(string_agg(md5(row_to_json(row({columns_str}))::text), '' ORDER BY id))
+        FROM {table_name}
+        WHERE id >= %s AND id < %s
+        """
+        if where_clause:
+            query += f" AND ({where_clause})"
+        query += " GROUP BY 1"
+        cursor.execute(query, (bucket_size, first_bucket * bucket_size, (last_bucket + 1) * bucket_size))
+        return dict(cursor.fetchall())
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def repair_range(source_db, target_db, table_name, start_id, end_id, where_clause=None):
+    """Transfer rows start_id <= id < end_id again in one target transaction"""
+    worker = Worker('repair', table_name, source_db, target_db, 'copy')
+    worker.repair_range(start_id - 1, end_id - 1, where_clause)
+
+
 class Validator:
     """Validator class, ensuring data integrity"""
-    
-    def __init__(self, source_db, target_db):
+
+    def __init__(self, source_db, target_db, workers=DEFAULT_VALIDATION_WORKERS,
+                 bucket_size=VALIDATION_BUCKET_ROWS, pool=None):
         """
-        Initialize validator
+        Initialize validator, queries run on pool if given, shared with the transfer
         """
         self.source_db = source_db
         self.target_db = target_db
-    
-    def _table_hash(self, conn, table_name, where_clause=None):
-        """Calculate hash for table"""
-        cursor = conn.cursor()
-        try:
-            # Column names
-            cursor.execute(f"SELECT * FROM {table_name} LIMIT 0")
-            columns = [desc[0] for desc in cursor.description]
-            columns_str = ', '.join(columns)
-            
-            query = f"""
-            SELECT md5(string_agg(row::text, ''))
-            FROM (
-                SELECT row_to_json(row({columns_str})) as row
-                FROM {table_name}
-            """
-            
-            if where_clause:
-                query += f" WHERE {where_clause}"
-                
-            query += " ORDER BY id) as subquery"
-            
-            cursor.execute(query)
-            result = cursor.fetchone()
-            return result[0] if result else None
-            
-        finally:
-            cursor.close()
-    
-    def _row_count(self, conn, table_name, where_clause=None):
-        """Count rows in table"""
-        cursor = conn.cursor()
-        try:
-            query = f"SELECT COUNT(*) FROM {table_name}"
-            if where_clause:
-                query += f" WHERE {where_clause}"
-                
-            cursor.execute(query)
-            return cursor.fetchone()[0]
-        finally:
-            cursor.close()
-    
-    def validate_table(self, table_name, where_clause=None):
-        """Validate data integrity"""
+        self.workers = workers
+        self.bucket_size = bucket_size
+        self.pool = pool
+
+    def _run_all(self, calls):
+        """Results of (function, args) calls in order, each opens its own connections"""
+        if self.pool is not None:
+            pending = [self.pool.apply_async(function, args) for function, args in calls]
+            return [result.get() for result in pending]
+        with ThreadPoolExecutor(max_workers=self.workers * 2) as executor:
+            futures = [executor.submit(function, *args) for function, args in calls]
+            return [future.result() for future in futures]
+
+    def range_digests(self, table_name, where_clause=None):
+        """
+        Leaf digests of both databases, hashed in parallel over segments of the id space,
+        returns (first bucket, source leaves, target leaves)
+        """
+        databases = (self.source_db, self.target_db)
+        bounds = self._run_all([(db_bounds, (db_name, table_name, where_clause)) for db_name in databases])
+        lows = [low for low, _ in bounds if low is not None]
+        highs = [high for _, high in bounds if high is not None]
+        if not lows:
+            return 0, [], []
+        first_bucket = min(lows) // self.bucket_size
+        last_bucket = max(highs) // self.bucket_size
+        buckets = last_bucket - first_bucket + 1
+
+        per_segment = -(-buckets // self.workers)
+        segments = [
+            (start, min(start + per_segment, last_bucket + 1) - 1)
+            for start in range(first_bucket, last_bucket + 1, per_segment)
+        ]
+        results = self._run_all([
+            (bucket_digests, (db_name, table_name, self.bucket_size, start, end, where_clause))
+            for db_name in databases for start, end in segments
+        ])
+        digests = {db_name: {} for db_name in databases}
+        for i, result in enumerate(results):
+            digests[databases[i // len(segments)]].update(result)
+
+        def leaves(db_name):
+            return [digests[db_name].get(bucket) for bucket in range(first_bucket, last_bucket + 1)]
+
+        return first_bucket, leaves(self.source_db), leaves(self.target_db)
+
+    def differing_ranges(self, table_name, where_clause=None):
+        """Id ranges [start, end) whose rows differ between source and target"""
+        first_bucket, source_leaves, target_leaves = self.range_digests(table_name, where_clause)
+        if not source_leaves:
+            return []
+        source_tree = merkle_tree(source_leaves)
+        target_tree = merkle_tree(target_leaves)
+        logger.info(f"{table_name}: {len(source_leaves)} ranges, source root {source_tree[-1][0]}, "
+                    f"target root {target_tree[-1][0]}")
+        return [
+            ((first_bucket + leaf) * self.bucket_size, (first_bucket + leaf + 1) * self.bucket_size)
+            for leaf in differing_leaves(source_tree, target_tree)
+        ]
+
+    def repair(self, table_name, ranges, where_clause=None):
+        """Transfer the given id ranges again, each in one target transaction"""
+        self._run_all([
+            (repair_range, (self.source_db, self.target_db, table_name, start_id, end_id, where_clause))
+            for start_id, end_id in ranges
+        ])
+        logger.info(f"Repaired {len(ranges)} ranges of {table_name}")
+
+    def validate_table(self, table_name, where_clause=None, repair=False):
+        """Validate data integrity, optionally re-transferring the ranges that differ"""
         logger.info(f"Validating table {table_name}...")
-        
-        source_conn = None
-        target_conn = None
-        
+
         try:
-            source_conn = connect(self.source_db)
-            target_conn = connect(self.target_db)
-            
-            # Compare row numbers
-            source_count = self._row_count(source_conn, table_name, where_clause)
-            target_count = self._row_count(target_conn, table_name, where_clause)
-
-            if source_count != target_count:
-                logger.error(f"Row count mismatch for {table_name}: Source={source_count}, Target={target_count}")
-                return False
-                
-            # Compare hashes for tables
-            source_hash = self._table_hash(source_conn, table_name, where_clause)
-            target_hash = self._table_hash(target_conn, table_name, where_clause)
-            
-            if source_hash != target_hash:
-                logger.error(f"Hash mismatch for {table_name}")
+            ranges = self.differing_ranges(table_name, where_clause)
+            if ranges and repair:
+                logger.warning(f"{len(ranges)} ranges of {table_name} differ, repairing")
+                self.repair(table_name, ranges, where_clause)
+                ranges = self.differing_ranges(table_name, where_clause)
+
+            if ranges:
+                shown = ', '.join(f"[{start}, {end})" for start, end in ranges[:20])
+                more = f" and {len(ranges) - 20} more" if len(ranges) > 20 else ""
+                logger.error(f"Data mismatch for {table_name} in id ranges {shown}{more}")
                 return False
-                
+
             logger.info(f"Validation passed for {table_name}")
             return True
-            
+
         except Exception as e:
             logger.error(f"Error during validation: {e}")
             return False
-            
-        finally:
-            if source_conn:
-                source_conn.close()
-            if target_conn:
-                target_conn.close()
\ No newline at end of file
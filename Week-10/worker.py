@@ -5,43 +5,87 @@ Handles the actual data transfer operations
 import logging
 import psycopg2
 import time
+import checkpoints
+from copy_stream import stream_copy
 from db import connect
 
 DEFAULT_BATCH_SIZE = 5000
-MAX_RETRIES = 3
-RETRY_DELAY = 5  # seconds
+COPY_BATCH_SIZE = 100000  # rows per COPY and commit with --engine copy
+# quick retries inside the worker, the Saga requeues the chunk after that
+MAX_RETRIES = 1
+RETRY_DELAY = 1  # seconds
 
 logger = logging.getLogger(__name__)
 
 class Worker:
     """Worker class, to handle portion of data transfer"""
     
-    def __init__(self, worker_id, table_name, source_db, target_db, mode):
+    def __init__(self, worker_id, table_name, source_db, target_db, mode, engine='insert', run_key=None):
         """Initialize worker"""
         self.worker_id = worker_id
         self.table_name = table_name
         self.source_db = source_db
         self.target_db = target_db
         self.mode = mode
+        self.engine = engine
+        self.run_key = run_key or checkpoints.run_key(table_name, mode)
+        # sync loads rows here first, then upserts them with one statement per batch
+        self.staging_table = f"staging_{table_name}"
         self.process_name = f"Worker-{worker_id}-{table_name}"
     
-    def fetch_rows(self, cursor, columns, batch_size, offset, limit, where_clause=None):
-        """Fetch a batch of rows"""
+    def fetch_rows(self, cursor, columns, batch_size, last_id, end_id, where_clause=None):
+        """Fetch the next batch of rows after last_id, keyset pagination keeps every batch an index range scan"""
         columns_str = ', '.join(columns)
         query = f"SELECT {columns_str} FROM {self.table_name}"
         
-        conditions = []
+        conditions = ["id > %s", "id <= %s"]
         if where_clause:
-            conditions.append(where_clause)
+            conditions.append(f"({where_clause})")
         
-        if conditions:
-            query += f" WHERE {' AND '.join(conditions)}"
+        query += f" WHERE {' AND '.join(conditions)}"
         
-        query += f" ORDER BY id LIMIT {limit} OFFSET {offset}"
-        cursor.execute(query)
+        query += " ORDER BY id LIMIT %s"
+        cursor.execute(query, (last_id, end_id, batch_size))
         return cursor.fetchall()
     
-    def insert_rows(self, cursor, columns, rows):
+    def batch_end_id(self, cursor, batch_size, last_id, end_id, where_clause=None):
+        """Id of the batch_size-th row after last_id, end_id if fewer rows are left"""
+        query = f"SELECT id FROM {self.table_name} WHERE id > %s AND id <= %s"
+        if where_clause:
+            query += f" AND ({where_clause})"
+        query += " ORDER BY id OFFSET %s LIMIT 1"
+        cursor.execute(query, (last_id, end_id, batch_size - 1))
+        row = cursor.fetchone()
+        return row[0] if row else end_id
+
+    def copy_rows(self, source_cursor, target_cursor, columns, last_id, batch_end, where_clause=None, target_table=None):
+        """Stream rows last_id < id <= batch_end with COPY, they never become Python tuples"""
+        conditions = ["id > %s", "id <= %s"]
+        if where_clause:
+            conditions.append(f"({where_clause})")
+        return stream_copy(
+            source_cursor, target_cursor, self.table_name, columns, conditions, (last_id, batch_end), target_table
+        )
+
+    def create_staging_table(self, cursor):
+        """Temporary table like the target one, emptied by every commit"""
+        cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {self.staging_table} "
+            f"(LIKE {self.table_name} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+
+    def upsert_staged(self, cursor, columns):
+        """Insert new and update existing rows from the staging table with one statement"""
+        columns_str = ', '.join(columns)
+        set_clause = ', '.join(f"{column} = EXCLUDED.{column}" for column in columns if column != 'id')
+        cursor.execute(
+            f"INSERT INTO {self.table_name} ({columns_str}) "
+            f"SELECT {columns_str} FROM {self.staging_table} "
+            f"ON CONFLICT (id) DO UPDATE SET {set_clause}"
+        )
+        return cursor.rowcount
+
+    def insert_rows(self, cursor, columns, rows, table_name=None):
         """Insert multiple rows with a single statement"""
         if not rows:
             return 0
@@ -53,77 +97,108 @@ class Worker:
             for row in rows
         )
         
-        cursor.execute(f"INSERT INTO {self.table_name} ({columns_str}) VALUES {args_str}")
-        return len(rows)
-    
-    def update_rows(self, cursor, columns, rows):
-        """Update rows one by one"""
-        if not rows:
-            return 0
-            
-        for row in rows:
-            id_value = row[0]  # First column is id
-            # Prepare SET clause for all columns except id
-            set_clauses = [f"{columns[i]} = %s" for i in range(1, len(columns))]
-            set_clause = ', '.join(set_clauses)
-            
-            update_query = f"UPDATE {self.table_name} SET {set_clause} WHERE id = %s"
-            cursor.execute(update_query, row[1:] + (id_value,))
-        
+        cursor.execute(f"INSERT INTO {table_name or self.table_name} ({columns_str}) VALUES {args_str}")
         return len(rows)
     
-    def process(self, start_id, end_id, where_clause=None, retry_state=None):
-        """Process a range of rows"""
+    def repair_range(self, start_id, end_id, where_clause=None):
+        """Make target rows start_id < id <= end_id equal to the source ones in one transaction"""
+        source_conn = connect(self.source_db)
+        target_conn = connect(self.target_db)
+        try:
+            source_cursor = source_conn.cursor()
+            target_cursor = target_conn.cursor()
+            source_cursor.execute(f"SELECT * FROM {self.table_name} LIMIT 0")
+            columns = [desc[0] for desc in source_cursor.description]
+
+            # Collect the source rows in the staging table, then apply them at once
+            self.create_staging_table(target_cursor)
+            last_id = start_id
+            while True:
+                rows = self.fetch_rows(source_cursor, columns, DEFAULT_BATCH_SIZE, last_id, end_id, where_clause)
+                if not rows:
+                    break
+                self.insert_rows(target_cursor, columns, rows, self.staging_table)
+                last_id = rows[-1][0]  # First column is id
+
+            # Rows the source does not have
+            query = f"DELETE FROM {self.table_name} WHERE id > %s AND id <= %s"
+            if where_clause:
+                query += f" AND ({where_clause})"
+            query += f" AND id NOT IN (SELECT id FROM {self.staging_table})"
+            target_cursor.execute(query, (start_id, end_id))
+            self.upsert_staged(target_cursor, columns)
+            target_conn.commit()
+        finally:
+            source_conn.close()
+            target_conn.close()
+
+    def process(self, start_id, end_id, where_clause=None):
+        """Process rows with start_id < id <= end_id, resuming after the last committed batch"""
         logger.info(f"{self.process_name}: Starting processing range {start_id} to {end_id}")
         
         retries = 0
         while retries <= MAX_RETRIES:
             try:
-                # Check if this range was already processed
-                if retry_state and retry_state.get(f"{self.worker_id}_completed", False):
-                    logger.info(f"{self.process_name}: Range was already processed")
-                    return True
-                
                 source_conn = connect(self.source_db)
                 target_conn = connect(self.target_db)
                 
                 source_cursor = source_conn.cursor()
                 target_cursor = target_conn.cursor()
                 
+                # Continue after the last batch committed by any earlier attempt or run
+                last_id = checkpoints.committed_id(target_cursor, self.run_key, start_id, end_id)
+                if last_id >= end_id:
+                    logger.info(f"{self.process_name}: Range was already processed")
+                    source_conn.close()
+                    target_conn.close()
+                    return True
+                if last_id > start_id:
+                    logger.info(f"{self.process_name}: Resuming after id {last_id}")
+                
                 # Column names
                 source_cursor.execute(f"SELECT * FROM {self.table_name} LIMIT 0")
                 columns = [desc[0] for desc in source_cursor.description]
 
+                # Copy writes into the table, sync into the staging table first
+                if self.mode == 'sync':
+                    self.create_staging_table(target_cursor)
+                    destination = self.staging_table
+                else:
+                    destination = self.table_name
+
                 # Process data in batches
                 batch_size = DEFAULT_BATCH_SIZE
                 processed = 0
-                offset = start_id
                 
-                while offset < end_id:
-                    # Batch limit
-                    limit = min(batch_size, end_id - offset)
-                    
-                    # Fetch batch of rows
-                    rows = self.fetch_rows(source_cursor, columns, batch_size, offset, limit, where_clause)
-                    if not rows:
-                        break
-                    
-                    # Process rows based on mode
-                    if self.mode in ('copy', 'sync'):
-                        rows_affected = self.insert_rows(target_cursor, columns, rows)
-                    elif self.mode == 'update':
-                        rows_affected = self.update_rows(target_cursor, columns, rows)
+                while last_id < end_id:
+                    if self.engine == 'copy':
+                        # Stream the next batch straight from COPY TO into COPY FROM
+                        batch_end = self.batch_end_id(source_cursor, COPY_BATCH_SIZE, last_id, end_id, where_clause)
+                        rows_affected = self.copy_rows(
+                            source_cursor, target_cursor, columns, last_id, batch_end, where_clause, destination
+                        )
+                        last_id = batch_end
+                    else:
+                        # Fetch batch of rows
+                        rows = self.fetch_rows(source_cursor, columns, batch_size, last_id, end_id, where_clause)
+                        if not rows:
+                            break
+                        rows_affected = self.insert_rows(target_cursor, columns, rows, destination)
+                        last_id = rows[-1][0]  # First column is id
 
-                    processed += rows_affected
-                    offset += batch_size
+                    if self.mode == 'sync':
+                        rows_affected = self.upsert_staged(target_cursor, columns)
 
+                    processed += rows_affected
+                    # The checkpoint commits together with the batch, never one without the other
+                    checkpoints.advance(target_cursor, self.run_key, start_id, end_id, last_id)
                     target_conn.commit()
                     
-                    logger.info(f"{self.process_name}: Processed {processed}/{end_id - start_id} rows")
+                    logger.info(f"{self.process_name}: Processed {processed} rows, up to id {last_id}/{end_id}")
                 
-                # Mark this range as completed in shared state
-                if retry_state is not None:
-                    retry_state[f"{self.worker_id}_completed"] = True
+                # No rows left before end_id, mark the range as done
+                checkpoints.advance(target_cursor, self.run_key, start_id, end_id, end_id)
+                target_conn.commit()
                 
                 source_conn.close()
                 target_conn.close()
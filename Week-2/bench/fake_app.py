@@ -0,0 +1,17 @@
+"""
+The auth service wired to in-memory postgres and redis stand-ins
+
+    uvicorn fake_app:app --app-dir bench --workers 1
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import fakes  # noqa: E402
+
+db.create_pg_pool = fakes.create_memory_pool
+db.create_redis_client = fakes.create_fake_redis
+
+from main import app  # noqa: E402,F401
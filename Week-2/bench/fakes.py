@@ -0,0 +1,92 @@
+"""
+Fakes Module
+In-memory stand-ins for the postgres pool and redis, so the service can be
+benchmarked without external servers (single uvicorn worker only, state is per process)
+"""
+import itertools
+from contextlib import asynccontextmanager
+
+import fakeredis
+
+
+class MemoryConnection:
+    """
+    answers the statements db.py sends for the users table
+    """
+
+    def __init__(self, table: dict, ids):
+        self.table = table
+        self.ids = ids
+
+    async def fetchval(self, query: str, *args):
+        if query.startswith("INSERT INTO users"):
+            user_id = next(self.ids)
+            self.table[user_id] = (user_id, args[1], args[0], args[2])
+            return user_id
+        if "nextval" in query:
+            return [next(self.ids) for _ in range(args[0])]
+        raise NotImplementedError(query)
+
+    async def fetchrow(self, query: str, *args):
+        if query.startswith("SELECT id, password, name, scopes FROM users"):
+            return self.table.get(args[0])
+        raise NotImplementedError(query)
+
+    async def execute(self, query: str, *args):
+        if query.startswith("UPDATE users SET password"):
+            user_id, _, name, scopes = self.table[args[1]]
+            self.table[user_id] = (user_id, args[0], name, scopes)
+            return "UPDATE 1"
+        if query.strip().upper() == "SELECT 1":
+            return "SELECT 1"
+        raise NotImplementedError(query)
+
+    async def copy_records_to_table(self, table_name: str, records, columns):
+        assert table_name == "users"
+        for record in records:
+            row = dict(zip(columns, record))
+            self.table[row["id"]] = (row["id"], row["password"], row["name"], row["scopes"])
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+class MemoryPool:
+    """
+    the subset of asyncpg.Pool used by db.py
+    """
+
+    def __init__(self, max_size: int = 90):
+        self.table = {}
+        self.max_size = max_size
+        self.in_use = 0
+        self._connection = MemoryConnection(self.table, itertools.count(1))
+
+    async def acquire(self, timeout=None):
+        self.in_use += 1
+        return self._connection
+
+    async def release(self, connection):
+        self.in_use -= 1
+
+    def get_size(self):
+        return self.max_size
+
+    def get_idle_size(self):
+        return self.max_size - self.in_use
+
+    def get_max_size(self):
+        return self.max_size
+
+    async def close(self):
+        pass
+
+
+async def create_memory_pool():
+    return MemoryPool()
+
+
+def create_fake_redis(host: str = "localhost", port: int = 6379):
+    # one fake server per host:port, like separate redis nodes
+    return fakeredis.FakeAsyncRedis(host=host, port=port)
@@ -0,0 +1,109 @@
+"""
+Parameterized load scenarios, pick one by class name
+
+    locust -f bench/locustfile.py CheckHeavy --host http://127.0.0.1:8001
+
+CheckHeavy      one login per user, then /check in a loop
+TokenHeavy      /token in a loop for the same users
+ColdUsers       every login is for a user that has not logged in yet
+RotationWindow  /token + /check in a loop, run the server with a short
+                TOKEN_EXPIRE_TIME so tokens keep crossing the rotation threshold
+
+Accounts are created once per locust process with /user/bulk, so registration
+is not part of the measured traffic.
+"""
+import itertools
+import os
+import random
+import secrets
+
+import requests
+from locust import FastHttpUser, task, constant, events
+
+BENCH_POOL_USERS = int(os.getenv("BENCH_POOL_USERS", "1000"))
+
+accounts = []
+next_cold = itertools.count()
+next_refresh = itertools.count()
+
+
+@events.test_start.add_listener
+def register_accounts(environment, **_kwargs):
+    """
+    bulk-register the account pool before load starts
+    """
+    passwords = [secrets.token_hex(10) for _ in range(BENCH_POOL_USERS)]
+    response = requests.post(
+        f"{environment.host}/user/bulk",
+        json=[{"name": secrets.token_hex(10), "password": password} for password in passwords],
+        timeout=600
+    )
+    response.raise_for_status()
+    accounts.extend(zip(response.json()["user_ids"], passwords))
+
+
+class AuthUser(FastHttpUser):
+    """
+    shared helpers, not a scenario
+    """
+    abstract = True
+    wait_time = constant(0)
+
+    def login(self, user_id, password):
+        response = self.client.post("/token", json={"user_id": user_id, "password": password})
+        return response.json()["access_token"]
+
+    def login_for_refresh(self, user_id, password):
+        response = self.client.post("/token", json={"user_id": user_id, "password": password})
+        return response.json()["refresh_token"]
+
+    def check(self, token):
+        self.client.get("/check", headers={"Authorization": f"Bearer {token}"})
+
+
+class CheckHeavy(AuthUser):
+    def on_start(self):
+        self.token = self.login(*random.choice(accounts))
+
+    @task
+    def check_token(self):
+        self.check(self.token)
+
+
+class TokenHeavy(AuthUser):
+    def on_start(self):
+        self.account = random.choice(accounts)
+
+    @task
+    def access_token(self):
+        self.login(*self.account)
+
+
+class RefreshHeavy(AuthUser):
+    """
+    the same renewals as TokenHeavy through /token/refresh, one account per locust user
+    since logins of the same session share its refresh token family
+    """
+    def on_start(self):
+        self.refresh_token = self.login_for_refresh(*accounts[next(next_refresh) % len(accounts)])
+
+    @task
+    def refresh(self):
+        response = self.client.post("/token/refresh", json={"refresh_token": self.refresh_token})
+        self.refresh_token = response.json()["refresh_token"]
+
+
+class ColdUsers(AuthUser):
+    @task
+    def first_login(self):
+        user_id, password = accounts[next(next_cold) % len(accounts)]
+        self.check(self.login(user_id, password))
+
+
+class RotationWindow(AuthUser):
+    def on_start(self):
+        self.account = random.choice(accounts)
+
+    @task
+    def login_and_check(self):
+        self.check(self.login(*self.account))
@@ -0,0 +1,97 @@
+"""
+Redis memory per session, legacy layout (full token as key and value) against
+the compact jti layout from token_store.py
+
+    python bench/memory.py --sessions 100000 --db 15
+
+Needs a real redis (REDIS_HOST / REDIS_PORT), the chosen db must be empty and is
+flushed between layouts.
+"""
+import argparse
+import json
+import os
+import secrets
+import sys
+import time
+
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SECRET", "bench-secret")
+
+import main  # noqa: E402
+import token_store  # noqa: E402
+
+BATCH = 1000
+
+
+def used_memory(client: redis.Redis) -> int:
+    return client.info("memory")["used_memory"]
+
+
+def write_legacy(client: redis.Redis, sessions: int):
+    """
+    token -> user id and user id -> token, as before the compact layout
+    """
+    pipe = client.pipeline(transaction=False)
+    for user_id in range(1, sessions + 1):
+        payload = {"user_id": user_id, "name": secrets.token_hex(10), "scopes": "user",
+                   "iat": int(time.time()), "exp": int(time.time()) + main.EXPIRE_TIME}
+        token = main.keyring.sign(payload)
+        pipe.set(token, user_id, ex=main.EXPIRE_TIME)
+        pipe.set(user_id, token, ex=main.EXPIRE_TIME)
+        if user_id % BATCH == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def write_compact(client: redis.Redis, sessions: int):
+    """
+    the same sessions in the jti / bucket layout, with their refresh token family
+    """
+    pipe = client.pipeline(transaction=False)
+    for user_id in range(1, sessions + 1):
+        jti = secrets.token_urlsafe(token_store.JTI_BYTES)
+        iat = int(time.time())
+        bucket = token_store.bucket_key(user_id)
+        family = secrets.token_urlsafe(token_store.FAMILY_BYTES)
+        _, digest = token_store.refresh_token_for(user_id, family, 0, b"bench")
+        pipe.set(token_store.session_key(jti), user_id, ex=main.EXPIRE_TIME)
+        pipe.hset(bucket, user_id, f"{jti}:{iat}:{iat + main.EXPIRE_TIME}:{family}")
+        pipe.expire(bucket, main.EXPIRE_TIME)
+        pipe.hset(token_store.family_key(family), mapping={
+            "user": user_id, "digest": digest, "generation": 0, "name": "bench", "scopes": "user"
+        })
+        pipe.expire(token_store.family_key(family), main.REFRESH_TOKEN_TTL)
+        if user_id % BATCH == 0:
+            pipe.execute()
+    pipe.execute()
+
+
+def measure(client: redis.Redis, write, sessions: int) -> dict:
+    client.flushdb()
+    before = used_memory(client)
+    write(client, sessions)
+    after = used_memory(client)
+    client.flushdb()
+    return {"bytes_total": after - before, "bytes_per_session": round((after - before) / sessions, 1)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--db", type=int, default=15)
+    args = parser.parse_args()
+
+    client = redis.Redis(
+        host=os.getenv("REDIS_HOST", "localhost"), port=int(os.getenv("REDIS_PORT", "6379")), db=args.db
+    )
+    if client.dbsize():
+        sys.exit(f"redis db {args.db} is not empty, pick another one with --db")
+
+    results = {
+        "sessions": args.sessions,
+        "legacy": measure(client, write_legacy, args.sessions),
+        "compact": measure(client, write_compact, args.sessions),
+    }
+    print(json.dumps(results, indent=2))
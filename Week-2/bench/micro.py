@@ -0,0 +1,126 @@
+"""
+Microbenchmarks for the auth service hot path functions
+
+    python bench/micro.py [--output micro.json]
+
+The check_asgi_* entries drive the whole app in-process for a cached token, so they
+are the per-request CPU of the framework path. Compare the lean introspection with
+the FastAPI routes by running once more with CHECK_FAST_PATH=0.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SECRET", "bench-secret")
+os.environ.setdefault("HASH_SALT", "bench-salt")
+
+import introspection  # noqa: E402
+import main  # noqa: E402
+import passwords  # noqa: E402
+from token_cache import TokenCache, token_digest, verified_tokens  # noqa: E402
+
+REPEAT = 5
+
+
+def measure(func, number: int) -> dict:
+    """
+    best of REPEAT runs, in microseconds per call
+    """
+    best = min(timeit.repeat(func, number=number, repeat=REPEAT)) / number
+    return {"us_per_op": round(best * 1e6, 3), "ops_per_sec": round(1 / best, 1)}
+
+
+def asgi_request(method: str, path: str, headers=(), body: bytes = b""):
+    """
+    a callable running one request through main.app, as uvicorn would call it
+    """
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "root_path": "", "query_string": b"", "headers": list(headers),
+        "server": ("bench", 80), "client": ("bench", 1),
+    }
+    loop = asyncio.new_event_loop()
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start" and message["status"] != 200:
+            raise RuntimeError(f"{path} answered {message['status']}")
+
+    return lambda: loop.run_until_complete(main.app(dict(scope), receive, send))
+
+
+def run_all() -> dict:
+    """
+    run every microbenchmark, returns {name: result}
+    """
+    payload = {"user_id": 1, "name": "bench", "scopes": "user"}
+    session = ("bench-session-jti", int(time.time()), int(time.time()) + main.EXPIRE_TIME)
+    token = main.create_access_token(payload, *session)
+    legacy_hash = hashlib.md5((passwords.HASH_SALT + "password").encode()).hexdigest()
+    scrypt_hash = passwords.hash_password_sync("password")
+
+    cache = TokenCache()
+    digest = token_digest(token)
+    cache.put(digest, introspection.active_body("user"), float("inf"))
+    verified_tokens.put(digest, introspection.active_body("user"), float("inf"))
+    batch = json.dumps({"tokens": [token] * 100}).encode()
+
+    results = {
+        "create_access_token": measure(lambda: main.create_access_token(payload, *session), 2000),
+        "check_decode": measure(lambda: main.keyring.decode(token), 2000),
+        "check_cache_hit": measure(lambda: cache.get(token_digest(token)), 20000),
+        "check_asgi_cache_hit": measure(asgi_request(
+            "GET", "/check", [(b"authorization", f"Bearer {token}".encode())]
+        ), 5000),
+        "check_batch_asgi_cache_hit_x100": measure(asgi_request(
+            "POST", "/check/batch", [(b"content-type", b"application/json")], batch
+        ), 500),
+        "password_verify_md5": measure(
+            lambda: passwords.verify_password_sync("password", legacy_hash), 20000
+        ),
+        "password_verify_scrypt": measure(
+            lambda: passwords.verify_password_sync("password", scrypt_hash), 20
+        ),
+    }
+
+    hasher = passwords.PasswordHasher()
+    # one loop for every repeat, the hasher's bulk semaphore binds to it
+    loop = asyncio.new_event_loop()
+    hasher.start()
+    try:
+        # throughput of the executor, not latency of one hash
+        batch = ["password"] * (hasher.workers * 4)
+        elapsed = min(timeit.repeat(
+            lambda: loop.run_until_complete(hasher.hash_many(batch)), number=1, repeat=REPEAT
+        ))
+        results["password_hash_scrypt_parallel"] = {
+            "us_per_op": round(elapsed / len(batch) * 1e6, 3),
+            "ops_per_sec": round(len(batch) / elapsed, 1),
+        }
+    finally:
+        hasher.shutdown()
+        loop.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    results = run_all()
+    results["check_fast_path"] = introspection.CHECK_FAST_PATH
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
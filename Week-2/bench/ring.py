@@ -0,0 +1,128 @@
+"""
+Sharded token store check against local redis-server processes
+
+    python bench/ring.py --nodes 3 --sessions 100000
+
+Starts nodes+1 redis-server processes on free ports, stores sessions on the first
+nodes, adds the last node, runs rebalance.py and reports how many keys moved and
+whether every session is still found on its new owner.
+"""
+import argparse
+import json
+import os
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import redis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import token_store  # noqa: E402
+from hash_ring import HashRing  # noqa: E402
+from rebalance import rebalance  # noqa: E402
+
+EXPIRE = 3600
+
+
+def free_port() -> int:
+    """
+    a port nothing listens on right now, picked by the kernel
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_nodes(count: int, workdir: str) -> tuple:
+    """
+    (processes, ports) of count redis-server processes
+    """
+    if not shutil.which("redis-server"):
+        sys.exit("redis-server is not on PATH")
+    processes = []
+    ports = []
+    for _ in range(count):
+        port = free_port()
+        ports.append(port)
+        processes.append(subprocess.Popen(
+            ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no", "--dir", workdir],
+            stdout=subprocess.DEVNULL
+        ))
+    for port in ports:
+        client = redis.Redis(port=port)
+        for _ in range(100):
+            try:
+                client.ping()
+                break
+            except redis.ConnectionError:
+                time.sleep(0.05)
+    return processes, ports
+
+
+def store_sessions(ring: HashRing, clients: dict, sessions: int) -> dict:
+    """
+    write sessions the way the issue script does, returns jti -> user id
+    """
+    issued = {}
+    pipes = {node: client.pipeline(transaction=False) for node, client in clients.items()}
+    for user_id in range(1, sessions + 1):
+        jti = secrets.token_urlsafe(token_store.JTI_BYTES)
+        pipe = pipes[ring.node_for(user_id)]
+        pipe.set(token_store.session_key(jti), user_id, ex=EXPIRE)
+        pipe.hset(token_store.bucket_key(user_id), user_id, f"{jti}:0:{EXPIRE}")
+        pipe.expire(token_store.bucket_key(user_id), EXPIRE)
+        issued[jti] = user_id
+    for pipe in pipes.values():
+        pipe.execute()
+    return issued
+
+
+def missing_sessions(ring: HashRing, clients: dict, issued: dict) -> int:
+    missing = 0
+    for jti, user_id in issued.items():
+        client = clients[ring.node_for(user_id)]
+        if client.get(token_store.session_key(jti)) is None:
+            missing += 1
+        if client.hget(token_store.bucket_key(user_id), user_id) is None:
+            missing += 1
+    return missing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--sessions", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        processes, ports = start_nodes(args.nodes + 1, workdir)
+        try:
+            names = [f"127.0.0.1:{port}" for port in ports]
+            clients = {name: redis.Redis(port=int(name.rsplit(":", 1)[1])) for name in names}
+            before, after = names[:-1], names
+
+            issued = store_sessions(HashRing(before), clients, args.sessions)
+            started = time.perf_counter()
+            report = rebalance(before, after)
+            elapsed = time.perf_counter() - started
+
+            moved = sum(node["sessions"] for node in report.values())
+            print(json.dumps({
+                "nodes_before": len(before),
+                "nodes_after": len(after),
+                "sessions": args.sessions,
+                "moved_sessions": moved,
+                "moved_fraction": round(moved / args.sessions, 4),
+                "ideal_fraction": round(1 / len(after), 4),
+                "missing_after_rebalance": missing_sessions(HashRing(after), clients, issued),
+                "rebalance_seconds": round(elapsed, 3),
+            }, indent=2))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Benchmark launcher, runs microbenchmarks and one load scenario and writes
+machine-readable results
+
+    python bench/run.py --scenario check_heavy --backend fake --output results/fake-check.json
+    python bench/run.py --scenario token_heavy --backend local --workers 8 --output new.json
+    python bench/run.py --compare old.json new.json
+
+--backend local  uses postgres / redis from .env (DB_*, REDIS_*)
+--backend fake   uses the in-memory stand-ins from bench/fakes.py (needs fakeredis[lua]),
+                 always a single worker
+"""
+import argparse
+import csv
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVICE_DIR = os.path.dirname(BENCH_DIR)
+
+SCENARIOS = {
+    "check_heavy": {"user_class": "CheckHeavy"},
+    "token_heavy": {"user_class": "TokenHeavy"},
+    "refresh_heavy": {"user_class": "RefreshHeavy"},
+    "cold_users": {"user_class": "ColdUsers", "pool_users": 20000},
+    # 8s tokens with a 2s refresh threshold, so a steady share of logins rotate
+    "rotation_window": {"user_class": "RotationWindow", "env": {"TOKEN_EXPIRE_TIME": "8"}},
+}
+READY_TIMEOUT = 60  # seconds
+STDERR_TAIL = 4000  # characters of service stderr shown when it does not get ready
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=SERVICE_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def wait_until_ready(url: str, workers: int, service: subprocess.Popen = None,
+                     timeout: float = READY_TIMEOUT) -> dict:
+    """
+    poll the readiness url until every worker has answered 200,
+    returns seconds until the first and the last worker was ready and each worker's
+    own import-to-warm time, fails early if the service exits
+    """
+    started = time.perf_counter()
+    first_ready = None
+    startup = {}
+    while time.perf_counter() - started < timeout:
+        if service is not None and service.poll() is not None:
+            raise RuntimeError(f"service exited with code {service.returncode} before it was ready")
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                body = json.load(response)
+        except OSError:
+            time.sleep(0.05)
+            continue
+        if first_ready is None:
+            first_ready = time.perf_counter() - started
+        startup[body["pid"]] = body["startup_seconds"]
+        if len(startup) >= workers:
+            return {
+                "first_ready_seconds": round(first_ready, 3),
+                "all_ready_seconds": round(time.perf_counter() - started, 3),
+                "worker_startup_seconds": sorted(startup.values()),
+            }
+    raise RuntimeError(f"{len(startup)} of {workers} workers ready within {timeout}s")
+
+
+def start_service(backend: str, workers: int, port: int, env: dict, stderr=None) -> subprocess.Popen:
+    """
+    start uvicorn for the chosen backend, uvloop and httptools come from requirements.txt
+    """
+    if backend == "fake":
+        app, app_dir, workers = "fake_app:app", BENCH_DIR, 1
+    else:
+        app, app_dir = "main:app", SERVICE_DIR
+    command = [
+        sys.executable, "-m", "uvicorn", app, "--app-dir", app_dir,
+        "--port", str(port), "--workers", str(workers),
+        "--loop", "uvloop", "--http", "httptools", "--log-level", "error",
+    ]
+    return subprocess.Popen(command, cwd=SERVICE_DIR, env=env, stderr=stderr)
+
+
+def run_micro() -> dict:
+    output = subprocess.check_output(
+        [sys.executable, os.path.join(BENCH_DIR, "micro.py")], cwd=SERVICE_DIR, text=True
+    )
+    return json.loads(output)
+
+
+def run_locust(scenario: dict, host: str, users: int, spawn_rate: int, duration: str,
+               env: dict, stats_prefix: str):
+    command = [
+        sys.executable, "-m", "locust", "-f", os.path.join(BENCH_DIR, "locustfile.py"),
+        scenario["user_class"], "--headless", "--only-summary",
+        "-u", str(users), "-r", str(spawn_rate), "-t", duration,
+        "--host", host, "--csv", stats_prefix,
+    ]
+    subprocess.run(command, cwd=SERVICE_DIR, env=env, check=False)
+
+
+def read_locust_stats(stats_prefix: str) -> dict:
+    """
+    per-endpoint results from the locust csv
+    """
+    results = {}
+    with open(f"{stats_prefix}_stats.csv", newline="") as f:
+        for row in csv.DictReader(f):
+            name = row["Name"] if row["Type"] else "total"
+            results[name] = {
+                "requests": int(row["Request Count"]),
+                "failures": int(row["Failure Count"]),
+                "rps": float(row["Requests/s"]),
+                "avg_ms": float(row["Average Response Time"]),
+                "p50_ms": float(row["50%"]),
+                "p95_ms": float(row["95%"]),
+                "p99_ms": float(row["99%"]),
+            }
+    return results
+
+
+def run(args) -> dict:
+    scenario = SCENARIOS[args.scenario]
+    env = dict(os.environ)
+    env.setdefault("SECRET", "bench-secret")
+    env.setdefault("HASH_SALT", "bench-salt")
+    # every locust user shares one ip, measure the service rather than the limiter
+    env.setdefault("RATE_LIMITS", "")
+    env.update(scenario.get("env", {}))
+    env["BENCH_POOL_USERS"] = str(args.pool_users or scenario.get("pool_users", 1000))
+
+    results = {
+        "commit": git_commit(),
+        "scenario": args.scenario,
+        "backend": args.backend,
+        "workers": 1 if args.backend == "fake" else args.workers,
+        "users": args.users,
+        "duration": args.duration,
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    if not args.skip_micro:
+        results["micro"] = run_micro()
+
+    host = f"http://127.0.0.1:{args.port}"
+    service_log = tempfile.TemporaryFile()
+    service = start_service(args.backend, args.workers, args.port, env, service_log)
+    try:
+        try:
+            results["startup"] = wait_until_ready(f"{host}/readyz", results["workers"], service)
+        except RuntimeError as e:
+            service_log.seek(0)
+            stderr = service_log.read().decode(errors="replace")[-STDERR_TAIL:]
+            raise RuntimeError(f"{e}, service stderr:\n{stderr}") from e
+        with tempfile.TemporaryDirectory() as tmp:
+            stats_prefix = os.path.join(tmp, "locust")
+            run_locust(scenario, host, args.users, args.spawn_rate, args.duration, env, stats_prefix)
+            results["load"] = read_locust_stats(stats_prefix)
+    finally:
+        service.terminate()
+        service.wait()
+        service_log.seek(0)
+        sys.stderr.write(service_log.read().decode(errors="replace"))
+        service_log.close()
+    return results
+
+
+def compare(old_path: str, new_path: str):
+    """
+    print rps and latency changes between two result files
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}  ({new['scenario']}, {new['backend']})")
+
+    def change(before, after):
+        return f"{before:>10.2f} -> {after:>10.2f}  ({(after - before) / before * 100 if before else 0:+.1f}%)"
+
+    for name, stats in new.get("load", {}).items():
+        if name in old.get("load", {}):
+            before = old["load"][name]
+            print(f"{name:<20} rps {change(before['rps'], stats['rps'])}")
+            print(f"{'':<20} p99 {change(before['p99_ms'], stats['p99_ms'])}")
+    if "startup" in old and "startup" in new:
+        print(f"{'all workers ready':<20} s   "
+              f"{change(old['startup']['all_ready_seconds'], new['startup']['all_ready_seconds'])}")
+    for name, stats in new.get("micro", {}).items():
+        if name in old.get("micro", {}) and "us_per_op" in stats:
+            print(f"{name:<30} us/op {change(old['micro'][name]['us_per_op'], stats['us_per_op'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--scenario", choices=list(SCENARIOS), default="check_heavy")
+    parser.add_argument("--backend", choices=["local", "fake"], default="fake")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--spawn-rate", type=int, default=50)
+    parser.add_argument("--duration", default="30s")
+    parser.add_argument("--pool-users", type=int)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
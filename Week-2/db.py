@@ -0,0 +1,292 @@
+"""
+Database Module
+Async PostgreSQL and Redis pools for the auth service
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import List, Tuple
+
+import asyncpg
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+
+from hash_ring import HashRing
+from metrics import PG_ACQUIRE_SECONDS, PG_WAITING, REQUESTS_SHED
+from rate_limit import RateLimiter
+from token_store import TokenStore
+from user_cache import UserCache
+
+load_dotenv()
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_NAME = os.getenv("DB_NAME")
+# kept open for the worker's lifetime, more are opened on demand up to PG_POOL_MAX
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "5"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "90"))
+# connections opened concurrently at startup, the ones above PG_POOL_MIN close when idle
+PG_PREWARM = int(os.getenv("PG_PREWARM", "10"))
+PG_IDLE_LIFETIME = float(os.getenv("PG_IDLE_LIFETIME", "300"))
+# longest a request may wait for a connection before it is shed
+PG_ACQUIRE_TIMEOUT = float(os.getenv("PG_ACQUIRE_TIMEOUT", "0.5"))
+# requests allowed to queue for a connection, later ones are shed at once
+PG_MAX_WAITING = int(os.getenv("PG_MAX_WAITING", "200"))
+# shed at once while the recent average wait is above this
+PG_SHED_WAIT = float(os.getenv("PG_SHED_WAIT", "0.2"))
+# longest /readyz waits for a connection, a saturated pool is busy, not down
+PG_READY_TIMEOUT = float(os.getenv("PG_READY_TIMEOUT", "5"))
+
+BULK_COPY_CHUNK = 5000
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "1000"))
+REDIS_ACQUIRE_TIMEOUT = float(os.getenv("REDIS_ACQUIRE_TIMEOUT", "0.5"))
+# connections opened per redis node at startup
+REDIS_PREWARM = int(os.getenv("REDIS_PREWARM", "10"))
+# token store nodes "host:port,host:port", the first one also holds caches and pub/sub
+REDIS_NODES = os.getenv("REDIS_NODES", f"{REDIS_HOST}:{REDIS_PORT}").split(",")
+# node list before the last change, set while rebalance.py moves keys
+REDIS_NODES_PREVIOUS = os.getenv("REDIS_NODES_PREVIOUS")
+
+# created by open_pools() inside the app lifespan, one set per worker
+pg_pool = None
+redis_client = None
+redis_nodes = {}
+tokens = None
+users = None
+limiter = None
+
+
+class PoolOverloaded(Exception):
+    """
+    raised instead of queueing when the postgres pool cannot serve a request in time
+    """
+
+
+class AcquireGate:
+    """
+    bounds the queue in front of the postgres pool, tracks a moving average of wait time
+    """
+    SMOOTHING = 0.1
+
+    def __init__(self, max_waiting: int = PG_MAX_WAITING, shed_wait: float = PG_SHED_WAIT):
+        self.max_waiting = max_waiting
+        self.shed_wait = shed_wait
+        self.waiting = 0
+        self.average_wait = 0.0
+
+    def admit(self):
+        """
+        raise PoolOverloaded if the request should not even start waiting
+        """
+        if self.waiting >= self.max_waiting:
+            REQUESTS_SHED.labels("pg_queue").inc()
+            raise PoolOverloaded()
+        # only shed on slow waits while others queue, so the average keeps getting samples
+        if self.average_wait > self.shed_wait and self.waiting > 0:
+            REQUESTS_SHED.labels("pg_wait").inc()
+            raise PoolOverloaded()
+
+    def record(self, waited: float):
+        self.average_wait += self.SMOOTHING * (waited - self.average_wait)
+        PG_ACQUIRE_SECONDS.observe(waited)
+
+
+gate = AcquireGate()
+
+
+async def create_pg_pool():
+    """
+    postgres pool factory, replaced by in-memory stand-ins in bench/
+    """
+    return await asyncpg.create_pool(
+        min_size=min(PG_POOL_MIN, PG_POOL_MAX),
+        max_size=PG_POOL_MAX,
+        max_inactive_connection_lifetime=PG_IDLE_LIFETIME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT,
+        database=DB_NAME
+    )
+
+
+def create_redis_client(host: str = REDIS_HOST, port: int = REDIS_PORT):
+    """
+    redis client factory, replaced by in-memory stand-ins in bench/
+    """
+    # waits up to REDIS_ACQUIRE_TIMEOUT for a free connection instead of failing at once
+    return aioredis.Redis(
+        connection_pool=aioredis.BlockingConnectionPool(
+            host=host, port=port, db=0, max_connections=REDIS_MAX_CONNECTIONS,
+            timeout=REDIS_ACQUIRE_TIMEOUT
+        )
+    )
+
+
+async def open_pools():
+    """
+    open postgres and redis pools for the current worker
+    """
+    global pg_pool, redis_client, redis_nodes, tokens, users, limiter
+    pg_pool = await create_pg_pool()
+    previous_nodes = REDIS_NODES_PREVIOUS.split(",") if REDIS_NODES_PREVIOUS else []
+    for node in REDIS_NODES + previous_nodes:
+        if node not in redis_nodes:
+            host, port = node.rsplit(":", 1)
+            redis_nodes[node] = create_redis_client(host, int(port))
+    redis_client = redis_nodes[REDIS_NODES[0]]
+    tokens = TokenStore(
+        redis_nodes, HashRing(REDIS_NODES), HashRing(previous_nodes) if previous_nodes else None
+    )
+    users = UserCache(redis_client, fetch_user)
+    limiter = RateLimiter(redis_client)
+
+
+async def _warm_pg_connection():
+    conn = await pg_pool.acquire()
+    try:
+        # also puts the hot statement into this connection's statement cache
+        await conn.fetchrow("SELECT id, password, name, scopes FROM users WHERE id = $1", 0)
+    finally:
+        await pg_pool.release(conn)
+
+
+async def _warm_redis_node(client: aioredis.Redis):
+    # concurrent pings make the pool open that many connections
+    await asyncio.gather(*(client.ping() for _ in range(REDIS_PREWARM)))
+
+
+async def warm_pools():
+    """
+    open PG_PREWARM postgres and REDIS_PREWARM connections per redis node concurrently
+    and load the token store scripts, so the first requests do not pay for it
+    """
+    await asyncio.gather(
+        *(_warm_pg_connection() for _ in range(min(PG_PREWARM, PG_POOL_MAX))),
+        *(_warm_redis_node(client) for client in redis_nodes.values()),
+        tokens.load_scripts(),
+    )
+
+
+async def check_pools():
+    """
+    raise if postgres or a redis node cannot be reached,
+    bypasses the acquire gate so a busy worker is not reported as unready
+    """
+    conn = await pg_pool.acquire(timeout=PG_READY_TIMEOUT)
+    try:
+        await conn.execute("SELECT 1")
+    finally:
+        await pg_pool.release(conn)
+    await asyncio.gather(*(client.ping() for client in redis_nodes.values()))
+
+
+async def close_pools():
+    """
+    close postgres and redis pools on application shutdown
+    """
+    global pg_pool, redis_client, redis_nodes, tokens, users, limiter
+    if pg_pool:
+        await pg_pool.close()
+        pg_pool = None
+        print("Postgres pool closed")
+    if redis_nodes:
+        for client in redis_nodes.values():
+            await client.aclose()
+        redis_nodes = {}
+        redis_client = None
+        tokens = None
+        users = None
+        limiter = None
+        print("Redis pool closed")
+
+
+@asynccontextmanager
+async def acquire():
+    """
+    borrow a postgres connection, it always goes back to the pool when the block exits,
+    raises PoolOverloaded when the queue is too long or the wait exceeds PG_ACQUIRE_TIMEOUT
+    """
+    gate.admit()
+    gate.waiting += 1
+    PG_WAITING.inc()
+    started = time.perf_counter()
+    try:
+        conn = await pg_pool.acquire(timeout=PG_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        REQUESTS_SHED.labels("pg_timeout").inc()
+        raise PoolOverloaded()
+    finally:
+        gate.waiting -= 1
+        PG_WAITING.dec()
+        gate.record(time.perf_counter() - started)
+    try:
+        yield conn
+    finally:
+        await pg_pool.release(conn)
+
+
+async def insert_user(name: str, password: str, scopes: str) -> int:
+    """
+    insert a user row and return its id
+    """
+    async with acquire() as conn:
+        user_id = await conn.fetchval(
+            "INSERT INTO users (name, password, scopes) VALUES ($1, $2, $3) RETURNING id",
+            name, password, scopes
+        )
+    # the id may have been looked up before it existed
+    await users.invalidate(user_id)
+    return user_id
+
+
+async def insert_users_bulk(rows: List[Tuple[str, str, str]]) -> List[int]:
+    """
+    insert (name, password, scopes) rows with COPY in one transaction,
+    returns the new ids in input order
+    """
+    user_ids = []
+    async with acquire() as conn:
+        async with conn.transaction():
+            for start in range(0, len(rows), BULK_COPY_CHUNK):
+                chunk = rows[start:start + BULK_COPY_CHUNK]
+                # COPY cannot return ids, so take them from the sequence up front
+                ids = await conn.fetchval(
+                    "SELECT array_agg(nextval(pg_get_serial_sequence('users', 'id'))) "
+                    "FROM generate_series(1, $1)",
+                    len(chunk)
+                )
+                await conn.copy_records_to_table(
+                    "users",
+                    records=[(user_id, *row) for user_id, row in zip(ids, chunk)],
+                    columns=["id", "name", "password", "scopes"]
+                )
+                user_ids.extend(ids)
+    await users.invalidate_many(user_ids)
+    return user_ids
+
+
+async def fetch_user(user_id: int):
+    """
+    fetch (id, password, name, scopes) of a user from postgres, None if there is no such user,
+    request handlers should go through the users cache instead
+    """
+    async with acquire() as conn:
+        return await conn.fetchrow(
+            "SELECT id, password, name, scopes FROM users WHERE id = $1",
+            user_id
+        )
+
+
+async def update_password(user_id: int, password: str):
+    """
+    replace a user's password hash
+    """
+    async with acquire() as conn:
+        await conn.execute("UPDATE users SET password = $1 WHERE id = $2", password, user_id)
+    await users.invalidate(user_id)
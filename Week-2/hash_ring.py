@@ -0,0 +1,41 @@
+"""
+Hash Ring Module
+Consistent hashing of keys onto redis nodes
+
+Every node owns VNODES points on the ring, a key belongs to the first point after
+its hash. Adding a node to N nodes moves only about 1/(N+1) of the keys.
+"""
+import bisect
+import hashlib
+from typing import Iterable
+
+VNODES = 160
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    maps keys to node names
+    """
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = VNODES):
+        self.nodes = list(nodes)
+        if not self.nodes:
+            raise ValueError("HashRing needs at least one node")
+        points = sorted(
+            (_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key) -> str:
+        """
+        name of the node owning key
+        """
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        i = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._owners[i % len(self._owners)]
@@ -0,0 +1,132 @@
+"""
+Introspection Module
+Lean ASGI handling of /check and /check/batch
+
+Answers of /check only have a few shapes, inactive or active with a scope string.
+They are encoded once and cached as bytes, and LeanIntrospection serves both paths
+straight from the ASGI scope: no routing, dependency injection, pydantic or response
+encoding. The FastAPI routes in main.py stay as the documented fallback, set
+CHECK_FAST_PATH=0 to use them.
+"""
+import json
+import os
+from typing import Optional
+
+CHECK_FAST_PATH = os.getenv("CHECK_FAST_PATH", "1") == "1"
+PATHS = ("/check", "/check/batch")
+
+INACTIVE_BODY = b'{"status":"inactive","scope":null}'
+# scope strings are few (user, admin, ...), anything beyond this is encoded per call
+ACTIVE_BODIES_LIMIT = 1024
+_active_bodies = {}
+
+JSON_HEADERS = [(b"content-type", b"application/json")]
+
+
+def active_body(scopes: str) -> bytes:
+    """
+    encoded answer for an active token with these scopes
+    """
+    body = _active_bodies.get(scopes)
+    if body is None:
+        body = b'{"status":"active","scope":' + json.dumps(scopes).encode() + b"}"
+        if len(_active_bodies) < ACTIVE_BODIES_LIMIT:
+            _active_bodies[scopes] = body
+    return body
+
+
+def batch_body(bodies) -> bytes:
+    """
+    encoded /check/batch answer from encoded single answers
+    """
+    return b'{"results":[' + b",".join(bodies) + b"]}"
+
+
+def bearer_token(authorization: str) -> Optional[str]:
+    """
+    token from an Authorization header value, None if it is not a bearer token
+    """
+    if not authorization.startswith("Bearer "):
+        return None
+    return authorization.split(" ")[1]
+
+
+def error_body(detail) -> bytes:
+    return json.dumps({"detail": detail}).encode()
+
+
+async def send_body(send, status: int, body: bytes, headers=None):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": JSON_HEADERS + (headers or []),
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+class LeanIntrospection:
+    """
+    plain ASGI middleware answering /check and /check/batch itself,
+    check_one(token) and check_many(tokens) return encoded answers,
+    exceptions of type shed are answered 503 like the app's overload handler
+    """
+
+    def __init__(self, app, check_one, check_many, batch_limit: int, shed=(), retry_after="1"):
+        self.app = app
+        self.check_one = check_one
+        self.check_many = check_many
+        self.batch_limit = batch_limit
+        self.shed = tuple(shed)
+        self.shed_headers = [(b"retry-after", str(retry_after).encode())]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in PATHS:
+            await self.app(scope, receive, send)
+            return
+        try:
+            if scope["path"] == "/check" and scope["method"] == "GET":
+                await self.check(scope, send)
+            elif scope["path"] == "/check/batch" and scope["method"] == "POST":
+                await self.check_batch(receive, send)
+            else:
+                await self.app(scope, receive, send)
+        except self.shed:
+            await send_body(send, 503, b"", self.shed_headers)
+
+    async def check(self, scope, send):
+        authorization = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                authorization = value.decode("latin-1")
+                break
+        if authorization is None:
+            await send_body(send, 422, error_body("Missing authorization header"))
+            return
+        token = bearer_token(authorization)
+        if token is None:
+            await send_body(send, 401, error_body("Invalid authorization header format"))
+            return
+        await send_body(send, 200, await self.check_one(token))
+
+    async def check_batch(self, receive, send):
+        try:
+            tokens = json.loads(await read_body(receive))["tokens"]
+        except (ValueError, TypeError, KeyError):
+            await send_body(send, 422, error_body("Body must be {\"tokens\": [...]}"))
+            return
+        if not isinstance(tokens, list) or not all(isinstance(token, str) for token in tokens):
+            await send_body(send, 422, error_body("tokens must be a list of strings"))
+            return
+        if len(tokens) > self.batch_limit:
+            await send_body(send, 422, error_body(f"At most {self.batch_limit} tokens per batch"))
+            return
+        await send_body(send, 200, await self.check_many(tokens))
@@ -30,18 +30,26 @@ class User(FastHttpUser):
 
         self.user_id = int(register(self.client, self.name, self.password))
         self.token = None
+        self.refresh_token = None
 
     @task
     def check_token(self):
-        response = self.client.post(
-            "/token",
-            json={
-                "user_id": self.user_id,
-                "password": self.password
-            },
-        )
+        if self.refresh_token is None:
+            response = self.client.post(
+                "/token",
+                json={
+                    "user_id": self.user_id,
+                    "password": self.password
+                },
+            )
+        else:
+            response = self.client.post(
+                "/token/refresh",
+                json={"refresh_token": self.refresh_token},
+            )
 
         self.token = response.json()["access_token"]
+        self.refresh_token = response.json()["refresh_token"]
 
         self.client.get(
             "/check",
@@ -4,32 +4,105 @@ Single instance performance with 8 workers: 13,3k rps
 Multi-instance performance with 15 workers total: 14.1k rps
 """
 import os
-import datetime
-import hashlib
+import asyncio
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List
 
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
 
 import jwt
-import psycopg2
-import psycopg2.pool
-import redis
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+import db
+import metrics
+from introspection import (
+    CHECK_FAST_PATH, INACTIVE_BODY, LeanIntrospection, active_body, batch_body, bearer_token
+)
+from metrics import timed
+from passwords import hasher, HashingOverloaded
+from profiler import install_signal_handler
+from rate_limit import RateLimited, client_ip
+from signing import KeyRing
+from token_cache import verified_tokens, token_digest, listen_invalidations
 
 load_dotenv()
-SECRET_KEY = os.getenv("SECRET")
-ALGORITHM = os.getenv("ALGORITHM")
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_HOST = os.getenv("DB_HOST")
-DB_PORT = os.getenv("DB_PORT")
-DB_NAME = os.getenv("DB_NAME")
-EXPIRE_TIME = 3600
+EXPIRE_TIME = int(os.getenv("TOKEN_EXPIRE_TIME", "3600"))
 REFRESH_THRESHOLD = int(EXPIRE_TIME * 0.25)
+REFRESH_TOKEN_TTL = int(os.getenv("REFRESH_TOKEN_TTL", str(7 * 24 * 3600)))
+
+BATCH_CHECK_LIMIT = int(os.getenv("BATCH_CHECK_LIMIT", "1000"))
+BULK_USER_LIMIT = int(os.getenv("BULK_USER_LIMIT", "100000"))
+BULK_HASH_CHUNK = 1000
+# chunks of one upload being hashed at once, reading the body waits beyond that
+BULK_HASH_TASKS = 2
+SHED_RETRY_AFTER = os.getenv("SHED_RETRY_AFTER", "1")
+JWKS_MAX_AGE = int(os.getenv("JWKS_MAX_AGE", "300"))
+
+keyring = KeyRing()
+
+# seconds from import to the end of pre-warming, None until this worker is ready
+IMPORTED_AT = time.perf_counter()
+startup_seconds = None
+ready = False
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """
+    open and pre-warm the pools when a worker starts, close them on shutdown,
+    /readyz answers 200 only in between
+    """
+    global ready, startup_seconds
+    await db.open_pools()
+    await db.warm_pools()
+    hasher.start()
+    install_signal_handler(asyncio.get_running_loop())
+    background = [
+        asyncio.create_task(listen_invalidations(db.redis_client)),
+        asyncio.create_task(metrics.sample_pools_forever(
+            lambda: (db.pg_pool, db.redis_client.connection_pool if db.redis_client else None)
+        )),
+    ]
+    startup_seconds = time.perf_counter() - IMPORTED_AT
+    print(f"Worker {os.getpid()} ready in {startup_seconds:.3f}s")
+    ready = True
+    try:
+        yield
+    finally:
+        ready = False
+        for task in background:
+            task.cancel()
+        await asyncio.gather(*background, return_exceptions=True)
+        hasher.shutdown()
+        await db.close_pools()
+
 
-HASH_SALT = os.getenv("HASH_SALT")
+app = FastAPI(lifespan=lifespan)
 
-app = FastAPI()
+
+@app.exception_handler(db.PoolOverloaded)
+@app.exception_handler(HashingOverloaded)
+@app.exception_handler(RedisConnectionError)
+async def overloaded(_request: Request, _exc: Exception):
+    """
+    shed requests the pools or the hashing executor cannot take right now,
+    a fast 503 is cheaper for everyone than a request that times out later
+    """
+    return Response(status_code=503, headers={"Retry-After": SHED_RETRY_AFTER})
+
+
+@app.exception_handler(RateLimited)
+async def rate_limited(_request: Request, exc: RateLimited):
+    """
+    the client is over its limit for this endpoint
+    """
+    return Response(status_code=429, headers={"Retry-After": str(math.ceil(exc.retry_after))})
 
 
 class UserRegister(BaseModel):
@@ -52,39 +125,31 @@ class TokenResponse(BaseModel):
     model for token response
     """
     access_token: str
+    refresh_token: str
 
+class RefreshRequest(BaseModel):
+    """
+    model for refresh token request
+    """
+    refresh_token: str
 
-pg_pool = psycopg2.pool.SimpleConnectionPool(
-    minconn=30,
-    maxconn=90,
-    user=DB_USER,
-    password=DB_PASSWORD,
-    host=DB_HOST,
-    port=DB_PORT,
-    database=DB_NAME
-)
-
-redis_pool = redis.ConnectionPool(host='localhost', port=6379, db=0, max_connections=1000)
-
-
-@app.on_event("shutdown")
-def shutdown_event():
+class BatchCheckRequest(BaseModel):
     """
-    close the database connection pool on application shutdown
+    model for batch token introspection, "Bearer " prefix is optional
     """
-    if pg_pool:
-        pg_pool.closeall()
-        print("Postgres pool closed")
+    tokens: List[str] = Field(max_length=BATCH_CHECK_LIMIT)
 
 
-def create_access_token(data: dict, expires_delta: int = EXPIRE_TIME) -> str:
+user_list = TypeAdapter(List[UserRegister])
+
+
+def create_access_token(data: dict, jti: str, issued_at: int, expires_at: int) -> str:
     """
-    create a jwt token
+    create a jwt token for a session, the same session always gives the same token
     """
     to_encode = data.copy()
-    expire = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_delta)
-    to_encode.update({"exp": expire, "iat": datetime.datetime.utcnow()})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    to_encode.update({"jti": jti, "iat": issued_at, "exp": expires_at})
+    encoded_jwt = keyring.sign(to_encode)
     return encoded_jwt
 
 
@@ -92,95 +157,305 @@ async def get_authorization_token(authorization: str = Header(...)):
     """
     get the authorization token from the request header
     """
-    if not authorization.startswith("Bearer "):
+    token = bearer_token(authorization)
+    if token is None:
         raise HTTPException(status_code=401, detail="Invalid authorization header format")
-    return authorization.split(" ")[1]
+    return token
 
 
 @app.post("/user")
-async def register_user(user: UserRegister):
+async def register_user(user: UserRegister, request: Request):
     """
     register a new user
     """
-    conn = pg_pool.getconn()
-
-    cur = conn.cursor()
-    hashed_password = hashlib.md5((HASH_SALT + user.password).encode()).hexdigest()
-    cur.execute(
-        "INSERT INTO users (name, password, scopes) VALUES (%s, %s, %s) RETURNING id",
-        (user.name, hashed_password, user.scopes)
-    )
-    user_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    pg_pool.putconn(conn)
+    await db.limiter.check("user", "ip", client_ip(request))
+    with timed("user", "password_hash"):
+        hashed_password = await hasher.hash(user.password)
+    with timed("user", "insert"):
+        user_id = await db.insert_user(user.name, hashed_password, user.scopes)
     return {"user_id": user_id, "name": user.name, "scopes": user.scopes}
 
 
+async def read_ndjson_users(request: Request) -> AsyncIterator[UserRegister]:
+    """
+    parse users from an NDJSON body as it arrives
+    """
+    buffer = b""
+    line_number = 0
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield parse_ndjson_user(line, line_number)
+    if buffer.strip():
+        yield parse_ndjson_user(buffer, line_number + 1)
+
+
+def parse_ndjson_user(line: bytes, line_number: int) -> UserRegister:
+    """
+    validate one NDJSON line, errors point at the line
+    """
+    try:
+        return UserRegister.model_validate_json(line)
+    except ValidationError as e:
+        raise RequestValidationError(
+            [{**error, "loc": ("body", line_number, *error["loc"])} for error in e.errors()]
+        )
+
+
+async def hash_users(users: List[UserRegister]) -> list:
+    """
+    (name, password hash, scopes) rows for a chunk of users
+    """
+    hashes = await hasher.hash_many([user.password for user in users])
+    return [(user.name, hashed, user.scopes) for user, hashed in zip(users, hashes)]
+
+
+@app.post("/user/bulk")
+async def register_users_bulk(request: Request):
+    """
+    register many users from a JSON array or an NDJSON upload (application/x-ndjson),
+    returns user ids in input order
+    """
+    await db.limiter.check("user_bulk", "ip", client_ip(request))
+    # hashing of each chunk starts while the rest of the body is still being read
+    chunks = []
+    pending = []
+    count = 0
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            async for user in read_ndjson_users(request):
+                pending.append(user)
+                count += 1
+                if count > BULK_USER_LIMIT:
+                    raise HTTPException(status_code=413, detail=f"At most {BULK_USER_LIMIT} users")
+                if len(pending) == BULK_HASH_CHUNK:
+                    if len(chunks) >= BULK_HASH_TASKS:
+                        # chunks finish in order, the bulk semaphore is fifo
+                        await chunks[-BULK_HASH_TASKS]
+                    chunks.append(asyncio.create_task(hash_users(pending)))
+                    pending = []
+        else:
+            try:
+                pending = user_list.validate_json(await request.body())
+            except ValidationError as e:
+                raise RequestValidationError(e.errors())
+            if len(pending) > BULK_USER_LIMIT:
+                raise HTTPException(status_code=413, detail=f"At most {BULK_USER_LIMIT} users")
+    except BaseException:
+        for chunk in chunks:
+            chunk.cancel()
+        raise
+    if pending:
+        chunks.append(asyncio.create_task(hash_users(pending)))
+
+    rows = []
+    with timed("user_bulk", "password_hash"):
+        for hashed in await asyncio.gather(*chunks):
+            rows.extend(hashed)
+    with timed("user_bulk", "copy"):
+        user_ids = await db.insert_users_bulk(rows)
+    return {"user_ids": user_ids}
+
+
 @app.post("/token", response_model=TokenResponse)
-async def access_token(token_request: TokenRequest):
+async def access_token(token_request: TokenRequest, request: Request):
     """
-    get token for a user
+    get token for a user, rate limited per client ip and per user before the password check
     """
-    conn = pg_pool.getconn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, password, name, scopes FROM users WHERE id = %s", 
-        (token_request.user_id,)
-    )
-    result = cur.fetchone()
+    await db.limiter.check("token", "ip", client_ip(request))
+    with timed("token", "user_lookup"):
+        result = await db.users.get(token_request.user_id)
     if not result:
         raise HTTPException(status_code=401)
     user_id, password, name, scopes = result
-    if hashlib.md5((HASH_SALT + token_request.password).encode()).hexdigest() != password:
+    await db.limiter.check("token", "user", user_id, scopes)
+    with timed("token", "password_verify"):
+        matches, needs_rehash = await hasher.verify(token_request.password, password)
+    if not matches:
         raise HTTPException(status_code=401)
-    cur.close()
-    pg_pool.putconn(conn)
-
-    redis_client = redis.Redis(connection_pool=redis_pool)
-    old_token = redis_client.get(user_id)
-    if old_token:
-        old_token = old_token.decode()
-        ttl = redis_client.ttl(old_token)
-
-        if ttl is not None and ttl < REFRESH_THRESHOLD:
-            payload = {"user_id": user_id, "name": name, "scopes": scopes}
-            new_token = create_access_token(payload)
-
-            redis_client.setex(new_token, EXPIRE_TIME, user_id)
-            redis_client.setex(user_id, EXPIRE_TIME, new_token)
-            return {"access_token": new_token}
-        return {"access_token": old_token}
+    if needs_rehash:
+        with timed("token", "password_rehash"):
+            await db.update_password(user_id, await hasher.hash(token_request.password))
+
     payload = {"user_id": user_id, "name": name, "scopes": scopes}
-    new_token = create_access_token(payload)
+    with timed("token", "redis_issue"):
+        jti, issued_at, expires_at, refresh_token = await db.tokens.issue(
+            user_id, name, scopes, EXPIRE_TIME, REFRESH_THRESHOLD, REFRESH_TOKEN_TTL
+        )
+    with timed("token", "jwt_encode"):
+        token = create_access_token(payload, jti, issued_at, expires_at)
+    return {"access_token": token, "refresh_token": refresh_token}
 
-    redis_client.setex(new_token, EXPIRE_TIME, int(user_id))
-    redis_client.setex(user_id, EXPIRE_TIME, new_token)
-    return {"access_token": new_token}
 
+@app.post("/token/refresh", response_model=TokenResponse)
+async def refresh_access_token(refresh_request: RefreshRequest):
+    """
+    new access token from a refresh token, without postgres or password hashing,
+    the refresh token is rotated and can only be used once
+    """
+    with timed("token_refresh", "redis_refresh"):
+        refreshed = await db.tokens.refresh(
+            refresh_request.refresh_token, EXPIRE_TIME, REFRESH_TOKEN_TTL
+        )
+    if refreshed is None:
+        raise HTTPException(status_code=401)
+    user_id, name, scopes, jti, issued_at, expires_at, refresh_token = refreshed
+    payload = {"user_id": user_id, "name": name, "scopes": scopes}
+    with timed("token_refresh", "jwt_encode"):
+        token = create_access_token(payload, jti, issued_at, expires_at)
+    return {"access_token": token, "refresh_token": refresh_token}
 
-@app.get("/check")
-async def check(token: str = Depends(get_authorization_token)):
+
+def check_result(payload: dict, stored_user_id) -> bytes:
     """
-    check token status
+    build the encoded /check answer from token claims and the user id stored in redis
     """
+    scopes = payload.get("scopes")
+    user_id = payload.get("user_id")
+    if scopes is None or user_id is None:
+        return INACTIVE_BODY
+    if stored_user_id == int(user_id):
+        return active_body(scopes)
+    return INACTIVE_BODY
+
+
+async def introspect(token: str) -> bytes:
+    """
+    encoded status of one token
+    """
+    digest = token_digest(token)
+    cached = verified_tokens.get(digest)
+    if cached is not None:
+        return cached
+
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with timed("check", "jwt_decode"):
+            payload = keyring.decode(token)
     except jwt.ExpiredSignatureError:
-        return {"status": "inactive", "scope": None}
+        return INACTIVE_BODY
     except Exception as e:
         print("\n\n\n\n\n Got invalid token: ", token, "\n")
         raise e
 
-    scopes = payload.get("scopes")
-    user_id = payload.get("user_id")
-    if scopes is None or user_id is None:
-        return {"status": "inactive", "scope": None}
-
-    redis_client = redis.Redis(connection_pool=redis_pool)
-    stored_token = redis_client.get(token)
-    if not stored_token:
-        return {"status": "inactive", "scope": None}
-    if int(stored_token.decode()) == int(user_id):
-        return {"status": "active", "scope": scopes}
-    return {"status": "inactive", "scope": None}
+    stored_user_id = None
+    generation = verified_tokens.generation()
+    if payload.get("scopes") is not None and payload.get("user_id") is not None:
+        with timed("check", "redis_get"):
+            stored_user_id = await db.tokens.user_for(token, payload)
+    result = check_result(payload, stored_user_id)
+
+    verified_tokens.put(digest, result, payload.get("exp", 0), payload.get("jti"), generation)
+    return result
+
+
+async def introspect_many(tokens: List[str]) -> bytes:
+    """
+    encoded status of many tokens, results are in request order
+    """
+    results = [INACTIVE_BODY] * len(tokens)
+    # (index, token, digest, payload) of tokens that need a redis lookup
+    pending = []
+    for i, token in enumerate(tokens):
+        if token.startswith("Bearer "):
+            token = token[len("Bearer "):]
+        digest = token_digest(token)
+        cached = verified_tokens.get(digest)
+        if cached is not None:
+            results[i] = cached
+            continue
+        try:
+            payload = keyring.decode(token)
+        except jwt.InvalidTokenError:
+            # one bad token must not fail the whole batch
+            continue
+        if payload.get("scopes") is None or payload.get("user_id") is None:
+            verified_tokens.put(digest, INACTIVE_BODY, payload.get("exp", 0), payload.get("jti"))
+            continue
+        pending.append((i, token, digest, payload))
+
+    if pending:
+        generation = verified_tokens.generation()
+        with timed("check_batch", "redis_mget"):
+            stored = await db.tokens.users_for_many(
+                [(token, payload) for _, token, _, payload in pending]
+            )
+        for (i, _, digest, payload), stored_user_id in zip(pending, stored):
+            results[i] = check_result(payload, stored_user_id)
+            verified_tokens.put(digest, results[i], payload.get("exp", 0), payload.get("jti"), generation)
+    return batch_body(results)
+
+
+@app.get("/check")
+async def check(token: str = Depends(get_authorization_token)):
+    """
+    check token status, served by LeanIntrospection unless CHECK_FAST_PATH=0
+    """
+    return Response(content=await introspect(token), media_type="application/json")
+
+
+@app.post("/check/batch")
+async def check_batch(request: BatchCheckRequest):
+    """
+    check status of many tokens, served by LeanIntrospection unless CHECK_FAST_PATH=0
+    """
+    return Response(content=await introspect_many(request.tokens), media_type="application/json")
+
+
+@app.get("/.well-known/jwks.json")
+async def jwks():
+    """
+    public keys for verifying tokens offline, see verifier.py
+    """
+    return Response(
+        content=keyring.jwks_json(),
+        media_type="application/json",
+        headers={"Cache-Control": f"public, max-age={JWKS_MAX_AGE}"}
+    )
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    liveness, the worker's event loop answers
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    readiness, the worker is warm and postgres and redis answer,
+    the load balancer should only route to workers that return 200
+    """
+    if not ready:
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    try:
+        await db.check_pools()
+    except Exception as e:
+        print("Readiness check failed: ", e)
+        return JSONResponse(status_code=503, content={"status": "unavailable"})
+    return {"status": "ready", "pid": os.getpid(), "startup_seconds": round(startup_seconds, 3)}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """
+    prometheus scrape endpoint
+    """
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+# added last so the lean introspection is still timed by RequestTimer
+if CHECK_FAST_PATH:
+    app.add_middleware(
+        LeanIntrospection,
+        check_one=introspect,
+        check_many=introspect_many,
+        batch_limit=BATCH_CHECK_LIMIT,
+        shed=(db.PoolOverloaded, RedisConnectionError),
+        retry_after=SHED_RETRY_AFTER,
+    )
+app.add_middleware(metrics.RequestTimer)
@@ -0,0 +1,139 @@
+"""
+Metrics Module
+Prometheus metrics for the auth service hot paths
+
+With several uvicorn workers set PROMETHEUS_MULTIPROC_DIR to an empty directory
+so /metrics aggregates every worker instead of reporting the one that answered.
+"""
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess
+)
+
+POOL_SAMPLE_INTERVAL = float(os.getenv("METRICS_POOL_INTERVAL", "1"))
+LATENCY_BUCKETS = (
+    .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5
+)
+# only these paths get their own label, anything else is "other"
+ENDPOINTS = {
+    "/user", "/user/bulk", "/token", "/token/refresh", "/check", "/check/batch",
+    "/.well-known/jwks.json", "/metrics", "/healthz", "/readyz"
+}
+
+REQUEST_SECONDS = Histogram(
+    "auth_request_seconds", "Request latency per endpoint",
+    ["endpoint"], buckets=LATENCY_BUCKETS
+)
+STAGE_SECONDS = Histogram(
+    "auth_stage_seconds", "Latency of a stage inside an endpoint",
+    ["endpoint", "stage"], buckets=LATENCY_BUCKETS
+)
+PG_ACQUIRE_SECONDS = Histogram(
+    "auth_pg_acquire_seconds", "Wait for a postgres connection", buckets=LATENCY_BUCKETS
+)
+POOL_CONNECTIONS = Gauge(
+    "auth_pool_connections", "Pool connections per state",
+    ["pool", "state"], multiprocess_mode="livesum"
+)
+PG_WAITING = Gauge(
+    "auth_pg_waiting", "Requests waiting for a postgres connection", multiprocess_mode="livesum"
+)
+REQUESTS_SHED = Counter(
+    "auth_requests_shed", "Requests answered 503 because of overload", ["reason"]
+)
+CACHE_REQUESTS = Counter(
+    "auth_cache_requests", "Cache lookups", ["cache", "result"]
+)
+RATE_LIMITED = Counter(
+    "auth_rate_limited", "Requests answered 429, by where the limit was found",
+    ["endpoint", "source"]
+)
+TOKENS_ISSUED = Counter(
+    "auth_tokens_issued", "Tokens returned by /token and /token/refresh", ["result"]
+)
+
+_stages = {}
+
+
+@contextmanager
+def timed(endpoint: str, stage: str):
+    """
+    observe the duration of a block as a stage of endpoint
+    """
+    histogram = _stages.get((endpoint, stage))
+    if histogram is None:
+        histogram = _stages[(endpoint, stage)] = STAGE_SECONDS.labels(endpoint, stage)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started)
+
+
+class RequestTimer:
+    """
+    plain ASGI middleware recording request latency per endpoint
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._children = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        endpoint = scope["path"] if scope["path"] in ENDPOINTS else "other"
+        histogram = self._children.get(endpoint)
+        if histogram is None:
+            histogram = self._children[endpoint] = REQUEST_SECONDS.labels(endpoint)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+
+def sample_pools(pg_pool, redis_pool):
+    """
+    record pool saturation of this worker
+    """
+    if pg_pool is not None:
+        size = pg_pool.get_size()
+        idle = pg_pool.get_idle_size()
+        POOL_CONNECTIONS.labels("postgres", "in_use").set(size - idle)
+        POOL_CONNECTIONS.labels("postgres", "idle").set(idle)
+        POOL_CONNECTIONS.labels("postgres", "max").set(pg_pool.get_max_size())
+    if redis_pool is not None:
+        # redis-py has no public accessors for these
+        POOL_CONNECTIONS.labels("redis", "in_use").set(len(redis_pool._in_use_connections))
+        POOL_CONNECTIONS.labels("redis", "idle").set(len(redis_pool._available_connections))
+        POOL_CONNECTIONS.labels("redis", "max").set(redis_pool.max_connections)
+
+
+async def sample_pools_forever(get_pools):
+    """
+    background task, get_pools returns the current (pg_pool, redis_pool)
+    """
+    while True:
+        sample_pools(*get_pools())
+        await asyncio.sleep(POOL_SAMPLE_INTERVAL)
+
+
+def render() -> bytes:
+    """
+    metrics in prometheus text format
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
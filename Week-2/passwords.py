@@ -0,0 +1,156 @@
+"""
+Passwords Module
+Password hashing off the event loop with a bounded executor
+
+Hashes are stored as  $scrypt$n=16384,r=8,p=1$<salt>$<hash>  (base64 salt and hash),
+so cost parameters can change without breaking existing rows. Legacy salted md5 hex
+digests still verify and are reported as needing a rehash.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+HASH_SALT = os.getenv("HASH_SALT")
+PASSWORD_SCRYPT_N = int(os.getenv("PASSWORD_SCRYPT_N", "16384"))
+PASSWORD_SCRYPT_R = int(os.getenv("PASSWORD_SCRYPT_R", "8"))
+PASSWORD_SCRYPT_P = int(os.getenv("PASSWORD_SCRYPT_P", "1"))
+# "thread" is enough since hashlib.scrypt releases the GIL, "process" isolates it fully
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
+# hashes running or queued per worker before new ones are refused
+PASSWORD_HASH_QUEUE = int(os.getenv("PASSWORD_HASH_QUEUE", "64"))
+
+SALT_BYTES = 16
+KEY_BYTES = 32
+SCHEME = "scrypt"
+
+
+class HashingOverloaded(Exception):
+    """
+    raised when too many hashes are already waiting for the executor
+    """
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.b64decode(data + "=" * (-len(data) % 4))
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(
+        password.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * n * r, dklen=KEY_BYTES
+    )
+
+
+def hash_password_sync(password: str, n: int = PASSWORD_SCRYPT_N,
+                       r: int = PASSWORD_SCRYPT_R, p: int = PASSWORD_SCRYPT_P) -> str:
+    """
+    hash a password with a fresh salt, blocking
+    """
+    salt = os.urandom(SALT_BYTES)
+    key = _scrypt(password, salt, n, r, p)
+    return f"${SCHEME}$n={n},r={r},p={p}${_b64encode(salt)}${_b64encode(key)}"
+
+
+def verify_password_sync(password: str, encoded: str) -> Tuple[bool, bool]:
+    """
+    check a password against a stored hash, blocking
+    returns (matches, needs_rehash)
+    """
+    if not encoded.startswith(f"${SCHEME}$"):
+        legacy = hashlib.md5((HASH_SALT + password).encode()).hexdigest()
+        return hmac.compare_digest(legacy, encoded), True
+
+    _, _, params, salt, key = encoded.split("$")
+    cost = dict(param.split("=") for param in params.split(","))
+    n, r, p = int(cost["n"]), int(cost["r"]), int(cost["p"])
+    matches = hmac.compare_digest(_scrypt(password, _b64decode(salt), n, r, p), _b64decode(key))
+    needs_rehash = (n, r, p) != (PASSWORD_SCRYPT_N, PASSWORD_SCRYPT_R, PASSWORD_SCRYPT_P)
+    return matches, needs_rehash
+
+
+class PasswordHasher:
+    """
+    runs hashing in an executor, refusing work beyond queue_size instead of
+    letting logins pile up behind it
+    """
+
+    def __init__(self, kind: str = PASSWORD_HASH_EXECUTOR, workers: int = PASSWORD_HASH_WORKERS,
+                 queue_size: int = PASSWORD_HASH_QUEUE):
+        self.kind = kind
+        self.workers = workers
+        self.queue_size = queue_size
+        self.in_flight = 0
+        self._executor = None
+        # shared by every bulk request, so all of them together use at most the executor width
+        self._bulk = None
+
+    def start(self):
+        """
+        create the executor, called from the app lifespan
+        """
+        if self.kind == "process":
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="password-hash"
+            )
+        self._bulk = asyncio.Semaphore(self.workers)
+
+    def shutdown(self):
+        """
+        stop the executor
+        """
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _run(self, func, *args):
+        if self.in_flight >= self.queue_size:
+            raise HashingOverloaded()
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.in_flight -= 1
+
+    async def hash(self, password: str) -> str:
+        """
+        hash a new password
+        """
+        return await self._run(hash_password_sync, password)
+
+    async def hash_many(self, passwords: List[str]) -> List[str]:
+        """
+        hash a batch of passwords in parallel, in input order
+        bulk work bypasses the admission limit but all concurrent calls together never use
+        more than the executor width, so logins queued behind it wait at most one round of hashes
+        """
+        loop = asyncio.get_running_loop()
+
+        async def hash_one(password):
+            async with self._bulk:
+                return await loop.run_in_executor(self._executor, hash_password_sync, password)
+
+        return await asyncio.gather(*(hash_one(password) for password in passwords))
+
+    async def verify(self, password: str, encoded: str) -> Tuple[bool, bool]:
+        """
+        returns (matches, needs_rehash), legacy md5 hashes are checked inline
+        """
+        if not encoded.startswith(f"${SCHEME}$"):
+            return verify_password_sync(password, encoded)
+        return await self._run(verify_password_sync, password, encoded)
+
+
+hasher = PasswordHasher()
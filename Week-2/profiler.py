@@ -0,0 +1,95 @@
+"""
+Profiler Module
+Sampling profiler that can be switched on in a single running worker
+
+    kill -USR2 <worker pid>     # start sampling
+    kill -USR2 <worker pid>     # stop, writes profile-<pid>-<time>.folded
+
+The output is in collapsed stack format, feed it to flamegraph.pl or speedscope.
+Sampling runs in a separate thread, so a stopped profiler costs nothing.
+"""
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL", "0.005"))  # seconds
+PROFILER_DIR = os.getenv("PROFILER_DIR", ".")
+
+
+class SamplingProfiler:
+    """
+    samples the stack of one thread at a fixed interval
+    """
+
+    def __init__(self, interval: float = PROFILER_INTERVAL, output_dir: str = PROFILER_DIR):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.target_thread = threading.main_thread().ident
+        self.samples = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self):
+        """
+        start sampling
+        """
+        if self.running:
+            return
+        self.samples.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        print(f"Profiler started in worker {os.getpid()}")
+
+    def stop(self) -> str:
+        """
+        stop sampling and write collapsed stacks, returns the file path
+        """
+        if not self.running:
+            return ""
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        path = os.path.join(self.output_dir, f"profile-{os.getpid()}-{int(time.time())}.folded")
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        print(f"Profiler stopped in worker {os.getpid()}, wrote {path}")
+        return path
+
+    def toggle(self):
+        """
+        start if stopped, stop if running
+        """
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.target_thread)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+
+profiler = SamplingProfiler()
+
+
+def install_signal_handler(loop, signum: int = signal.SIGUSR2):
+    """
+    toggle the profiler of this worker on signum
+    """
+    loop.add_signal_handler(signum, profiler.toggle)
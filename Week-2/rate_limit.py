@@ -0,0 +1,144 @@
+"""
+Rate Limit Module
+Token bucket rate limits shared by every worker through redis
+
+Buckets are GCRA counters (one timestamp per key) updated atomically by a Lua
+script using the redis clock, so app servers with skewed clocks agree. A denied
+key is remembered in-process until its retry time, repeated requests from the
+same client are then rejected without a redis round trip.
+
+RATE_LIMITS is a comma separated list of <endpoint>:<key>[:<scope>]=<requests>/<seconds>
+    token:ip=30/1         every client ip may call /token 30 times per second
+    token:user=5/1        and every user id 5 times per second,
+    token:user:admin=50/1 admins 50 times
+Endpoints without a rule are not limited, nothing is limited by default.
+Behind a proxy or load balancer every client has the proxy's ip, ip rules then
+need RATE_LIMIT_TRUST_FORWARDED=1 and a proxy that sets X-Forwarded-For.
+"""
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+import redis.asyncio as aioredis
+
+from metrics import RATE_LIMITED
+
+# opt-in, e.g. "token:ip=30/1,token:user=5/1,user:ip=10/1"
+RATE_LIMITS = os.getenv("RATE_LIMITS", "")
+# trust the first X-Forwarded-For address, only behind a proxy that sets it
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "0") == "1"
+# denied keys remembered per worker, the map is pruned when it grows beyond this
+PREFILTER_SIZE = 100000
+
+# KEYS[1] bucket, ARGV: microseconds per request, burst
+# the key holds the theoretical arrival time of the next request,
+# returns {1, 0} when allowed or {0, microseconds until the next request is allowed}
+ALLOW_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) * 1000000 + tonumber(now[2])
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tat = tonumber(redis.call('GET', KEYS[1]) or '0')
+if tat < now then
+    tat = now
+end
+local next_tat = tat + interval
+local wait = next_tat - now - burst * interval
+if wait > 0 then
+    return {0, math.ceil(wait)}
+end
+redis.call('SET', KEYS[1], string.format('%d', next_tat), 'PX', math.ceil((next_tat - now) / 1000))
+return {1, 0}
+"""
+
+
+class RateLimited(Exception):
+    """
+    raised when a client is over its limit, retry_after is in seconds
+    """
+
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def parse_limits(spec: str) -> Dict[Tuple[str, str, Optional[str]], Tuple[int, float]]:
+    """
+    {(endpoint, key, scope or None): (requests, seconds)} from a RATE_LIMITS string
+    """
+    limits = {}
+    for rule in filter(None, (rule.strip() for rule in spec.split(","))):
+        name, _, limit = rule.partition("=")
+        endpoint, key, *scope = name.split(":", 2)
+        requests, _, seconds = limit.partition("/")
+        limits[(endpoint, key, scope[0] if scope else None)] = (int(requests), float(seconds or 1))
+    return limits
+
+
+def client_ip(request) -> str:
+    """
+    address of the client that sent a starlette request
+    """
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+class RateLimiter:
+    """
+    checks requests against the configured limits, raises RateLimited when over
+    """
+
+    def __init__(self, redis_client: aioredis.Redis, limits: Optional[dict] = None):
+        self.redis = redis_client
+        self.limits = parse_limits(RATE_LIMITS) if limits is None else limits
+        self._allow = redis_client.register_script(ALLOW_SCRIPT)
+        # bucket key -> time.monotonic() before which it is denied without asking redis
+        self._denied_until = {}
+
+    def limit_for(self, endpoint: str, key: str, scope: Optional[str] = None):
+        """
+        (requests, seconds) for a scope, falling back to the endpoint's default, or None
+        """
+        if scope is not None and (endpoint, key, scope) in self.limits:
+            return self.limits[(endpoint, key, scope)]
+        return self.limits.get((endpoint, key, None))
+
+    async def check(self, endpoint: str, key: str, value, scope: Optional[str] = None):
+        """
+        count one request of value (an ip or user id) against the endpoint's limit
+        """
+        limit = self.limit_for(endpoint, key, scope)
+        if limit is None:
+            return
+        bucket = f"rl:{endpoint}:{key}:{value}"
+        now = time.monotonic()
+        denied_until = self._denied_until.get(bucket)
+        if denied_until is not None:
+            if denied_until > now:
+                RATE_LIMITED.labels(endpoint, "local").inc()
+                raise RateLimited(denied_until - now)
+            del self._denied_until[bucket]
+
+        requests, seconds = limit
+        allowed, wait = await self._allow(
+            keys=[bucket], args=[int(seconds * 1000000 / requests), requests]
+        )
+        if allowed:
+            return
+        retry_after = wait / 1000000
+        self._remember(bucket, now + retry_after)
+        RATE_LIMITED.labels(endpoint, "redis").inc()
+        raise RateLimited(retry_after)
+
+    def _remember(self, bucket: str, until: float):
+        if len(self._denied_until) >= PREFILTER_SIZE:
+            now = time.monotonic()
+            self._denied_until = {
+                key: value for key, value in self._denied_until.items() if value > now
+            }
+            if len(self._denied_until) >= PREFILTER_SIZE:
+                self._denied_until.clear()
+        self._denied_until[bucket] = until
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Move token store keys after redis nodes were added or removed
+
+    1. deploy with REDIS_NODES=<new list> REDIS_NODES_PREVIOUS=<old list>
+       (lookups that miss on the new owner fall back to the old one)
+    2. python rebalance.py --previous <old list> --nodes <new list>
+    3. deploy again without REDIS_NODES_PREVIOUS
+
+Only keys whose owner changed are touched, about 1/(N+1) of them when a node is added
+to N. Every key is copied before it is deleted, so lookups keep finding it.
+"""
+import argparse
+from collections import defaultdict
+
+import redis
+
+from hash_ring import HashRing
+
+SCAN_COUNT = 1000
+
+
+def connect(node: str) -> redis.Redis:
+    host, port = node.rsplit(":", 1)
+    return redis.Redis(host=host, port=int(port))
+
+
+def move_sessions(source_name: str, source: redis.Redis, ring: HashRing, clients: dict) -> int:
+    """
+    move t:<jti> -> user id keys whose user is now owned by another node
+    """
+    moved = 0
+    for key in source.scan_iter(match="t:*", count=SCAN_COUNT):
+        user_id = source.get(key)
+        if user_id is None:
+            continue
+        target = ring.node_for(int(user_id))
+        if target == source_name:
+            continue
+        ttl = source.pttl(key)
+        if ttl == -2:
+            continue
+        clients[target].set(key, user_id, px=ttl if ttl > 0 else None)
+        source.delete(key)
+        moved += 1
+    return moved
+
+
+def move_buckets(source_name: str, source: redis.Redis, ring: HashRing, clients: dict) -> int:
+    """
+    move user fields of u:<bucket> hashes whose user is now owned by another node,
+    fields already on the target are kept
+    """
+    moved = 0
+    for key in source.scan_iter(match="u:*", count=SCAN_COUNT):
+        ttl = source.pttl(key)
+        fields = defaultdict(dict)
+        for user_id, session in source.hgetall(key).items():
+            target = ring.node_for(int(user_id))
+            if target != source_name:
+                fields[target][user_id] = session
+        for target, mapping in fields.items():
+            pipe = clients[target].pipeline()
+            # logins during step 1 already wrote newer sessions to the target, those win
+            for user_id, session in mapping.items():
+                pipe.hsetnx(key, user_id, session)
+            if ttl > 0:
+                # the bucket lives as long as its newest session, keep the longer ttl
+                pipe.pexpire(key, ttl, gt=True)
+                pipe.pexpire(key, ttl, nx=True)
+            pipe.execute()
+            source.hdel(key, *mapping)
+            moved += len(mapping)
+    return moved
+
+
+def move_refresh_tokens(source_name: str, source: redis.Redis, ring: HashRing, clients: dict) -> int:
+    """
+    move f:<family> refresh token families whose user is now owned by another node
+    """
+    moved = 0
+    for key in source.scan_iter(match="f:*", count=SCAN_COUNT):
+        family = source.hgetall(key)
+        if not family:
+            continue
+        target = ring.node_for(int(family[b"user"]))
+        if target == source_name:
+            continue
+        # a family already on the target was refreshed there, it is the newer one
+        if not clients[target].exists(key):
+            ttl = source.pttl(key)
+            pipe = clients[target].pipeline()
+            pipe.hset(key, mapping=family)
+            if ttl > 0:
+                pipe.pexpire(key, ttl)
+            pipe.execute()
+        source.delete(key)
+        moved += 1
+    return moved
+
+
+def rebalance(previous_nodes: list, nodes: list) -> dict:
+    """
+    move keys of every previous node to their owner on the new ring
+    """
+    ring = HashRing(nodes)
+    clients = {node: connect(node) for node in set(previous_nodes) | set(nodes)}
+    report = {}
+    for node in previous_nodes:
+        report[node] = {
+            "sessions": move_sessions(node, clients[node], ring, clients),
+            "users": move_buckets(node, clients[node], ring, clients),
+            "refresh_tokens": move_refresh_tokens(node, clients[node], ring, clients),
+        }
+        print(f"{node}: moved {report[node]['sessions']} sessions, {report[node]['users']} users, "
+              f"{report[node]['refresh_tokens']} refresh tokens")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--previous", required=True, help="host:port,host:port before the change")
+    parser.add_argument("--nodes", required=True, help="host:port,host:port after the change")
+    args = parser.parse_args()
+    rebalance(args.previous.split(","), args.nodes.split(","))
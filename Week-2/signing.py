@@ -0,0 +1,130 @@
+"""
+Signing Module
+JWT signing keys with key ids, HS secret or asymmetric (EdDSA / RS256) key ring
+
+Asymmetric keys are PEM private keys in JWT_KEYS_DIR, the file name (without .pem)
+is the key id. Tokens are signed with JWT_SIGNING_KID, or the last key id in sorted
+order, every key in the directory stays in the JWKS so tokens signed with a previous
+key keep verifying. To rotate: add a new key, point JWT_SIGNING_KID at it, restart
+workers, and delete the old file once its tokens expired.
+
+Generate a key:  python signing.py <kid>
+"""
+import json
+import os
+import sys
+from typing import Optional
+
+import jwt
+from jwt.algorithms import OKPAlgorithm, RSAAlgorithm
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from dotenv import load_dotenv
+
+load_dotenv()
+SECRET_KEY = os.getenv("SECRET")
+ALGORITHM = os.getenv("ALGORITHM", "HS256")
+JWT_KEYS_DIR = os.getenv("JWT_KEYS_DIR", "keys")
+JWT_SIGNING_KID = os.getenv("JWT_SIGNING_KID")
+
+ASYMMETRIC_ALGORITHMS = {"EdDSA": OKPAlgorithm, "RS256": RSAAlgorithm}
+
+
+class KeyRing:
+    """
+    signs tokens with the current key and verifies tokens of any known key
+    """
+
+    def __init__(self, algorithm: str = ALGORITHM, keys_dir: str = JWT_KEYS_DIR,
+                 signing_kid: Optional[str] = JWT_SIGNING_KID, secret: Optional[str] = SECRET_KEY):
+        self.algorithm = algorithm
+        self.private_keys = {}
+        self.public_keys = {}
+        self.signing_kid = None
+
+        if algorithm not in ASYMMETRIC_ALGORITHMS:
+            self.secret = secret
+            self.jwks = {"keys": []}
+            self._jwks_json = json.dumps(self.jwks).encode()
+            return
+
+        for file_name in sorted(os.listdir(keys_dir)):
+            if not file_name.endswith(".pem"):
+                continue
+            kid = file_name[:-len(".pem")]
+            with open(os.path.join(keys_dir, file_name), "rb") as f:
+                private_key = serialization.load_pem_private_key(f.read(), password=None)
+            self.private_keys[kid] = private_key
+            self.public_keys[kid] = private_key.public_key()
+        if not self.private_keys:
+            raise RuntimeError(f"No signing keys in {keys_dir}")
+
+        self.signing_kid = signing_kid or list(self.private_keys)[-1]
+        if self.signing_kid not in self.private_keys:
+            raise RuntimeError(f"Signing key {self.signing_kid} not found in {keys_dir}")
+
+        jwk_algorithm = ASYMMETRIC_ALGORITHMS[algorithm]
+        keys = []
+        for kid, public_key in self.public_keys.items():
+            jwk = jwk_algorithm.to_jwk(public_key, as_dict=True)
+            jwk.update({"kid": kid, "alg": algorithm, "use": "sig"})
+            keys.append(jwk)
+        self.jwks = {"keys": keys}
+        self._jwks_json = json.dumps(self.jwks).encode()
+
+    def sign(self, payload: dict) -> str:
+        """
+        encode a jwt with the current key
+        """
+        if self.signing_kid is None:
+            return jwt.encode(payload, self.secret, algorithm=self.algorithm)
+        return jwt.encode(
+            payload,
+            self.private_keys[self.signing_kid],
+            algorithm=self.algorithm,
+            headers={"kid": self.signing_kid}
+        )
+
+    def decode(self, token: str) -> dict:
+        """
+        verify and decode a jwt, raises jwt.InvalidTokenError subclasses like jwt.decode
+        """
+        if self.signing_kid is None:
+            return jwt.decode(token, self.secret, algorithms=[self.algorithm])
+        kid = jwt.get_unverified_header(token).get("kid")
+        public_key = self.public_keys.get(kid)
+        if public_key is None:
+            raise jwt.InvalidTokenError(f"Unknown key id {kid}")
+        return jwt.decode(token, public_key, algorithms=[self.algorithm])
+
+    def jwks_json(self) -> bytes:
+        """
+        encoded JWKS document, computed once since keys only change on restart
+        """
+        return self._jwks_json
+
+
+def generate_key(kid: str, algorithm: str = ALGORITHM, keys_dir: str = JWT_KEYS_DIR):
+    """
+    write a new private key to keys_dir/<kid>.pem
+    """
+    if algorithm == "EdDSA":
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    elif algorithm == "RS256":
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    else:
+        raise ValueError(f"{algorithm} does not use key files")
+    os.makedirs(keys_dir, exist_ok=True)
+    path = os.path.join(keys_dir, f"{kid}.pem")
+    with open(path, "xb") as f:
+        f.write(private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        ))
+    os.chmod(path, 0o600)
+    print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    generate_key(sys.argv[1])
@@ -0,0 +1,157 @@
+"""
+Token Cache Module
+In-process cache of verified tokens, invalidated across workers over redis pub/sub
+"""
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import redis.asyncio as aioredis
+
+from metrics import CACHE_REQUESTS
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "100000"))
+# upper bound on how long a cached answer is trusted if an invalidation is lost
+TOKEN_CACHE_TTL = int(os.getenv("TOKEN_CACHE_TTL", "30"))
+INVALIDATION_CHANNEL = os.getenv("TOKEN_INVALIDATION_CHANNEL", "auth:token:invalidate")
+RESUBSCRIBE_DELAY = 1  # seconds
+
+HITS = CACHE_REQUESTS.labels("token", "hit")
+MISSES = CACHE_REQUESTS.labels("token", "miss")
+
+
+def token_digest(token: str) -> str:
+    """
+    digest used as cache key, and as session id of legacy tokens without a jti
+    """
+    return hashlib.sha1(token.encode()).hexdigest()
+
+
+class TokenCache:
+    """
+    bounded LRU of token digest -> encoded /check answer, entries die at token exp,
+    invalidation is by session id (the token jti) since that is all redis knows
+
+    answers are looked up in redis before they are put, an invalidation that arrives in
+    between finds nothing to drop, so callers take generation() before the lookup and
+    put() skips the answer if its session was invalidated since
+    """
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE, ttl: int = TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._sessions = {}
+        # session -> generation it was last invalidated at, the oldest are forgotten
+        self._invalidated = OrderedDict()
+        self._generation = 0
+        # newest generation that is no longer known per session, or of the last clear
+        self._forgotten = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, digest: str):
+        """
+        cached result for a token digest, None on miss or expired entry
+        """
+        entry = self._entries.get(digest)
+        if entry is None:
+            MISSES.inc()
+            return None
+        expires_at, result, session = entry
+        if expires_at <= time.time():
+            self._drop(digest, session)
+            MISSES.inc()
+            return None
+        self._entries.move_to_end(digest)
+        HITS.inc()
+        return result
+
+    def generation(self) -> int:
+        """
+        taken before looking up an answer, passed to put()
+        """
+        return self._generation
+
+    def put(self, digest: str, result: bytes, exp: float, session: Optional[str] = None,
+            since: Optional[int] = None):
+        """
+        cache a result until the token expires or the cache ttl passes,
+        unless its session was invalidated after generation since
+        """
+        expires_at = min(exp, time.time() + self.ttl)
+        if expires_at <= time.time():
+            return
+        session = session or digest
+        if since is not None and (self._invalidated.get(session, 0) > since or self._forgotten > since):
+            return
+        self._entries[digest] = (expires_at, result, session)
+        self._entries.move_to_end(digest)
+        self._sessions[session] = digest
+        if len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._drop(oldest, self._entries[oldest][2])
+
+    def _drop(self, digest: str, session: str):
+        del self._entries[digest]
+        if self._sessions.get(session) == digest:
+            del self._sessions[session]
+
+    def invalidate(self, session: str):
+        """
+        drop the token of a session
+        """
+        self._generation += 1
+        self._invalidated[session] = self._generation
+        self._invalidated.move_to_end(session)
+        if len(self._invalidated) > self.max_size:
+            _, self._forgotten = self._invalidated.popitem(last=False)
+        digest = self._sessions.pop(session, None)
+        if digest is not None:
+            self._entries.pop(digest, None)
+
+    def clear(self):
+        """
+        drop everything
+        """
+        self._entries.clear()
+        self._sessions.clear()
+        self._generation += 1
+        self._invalidated.clear()
+        self._forgotten = self._generation
+
+
+verified_tokens = TokenCache()
+
+
+async def publish_invalidation(redis_client: aioredis.Redis, session: str):
+    """
+    tell every worker (including this one) to forget the token of a session
+    """
+    verified_tokens.invalidate(session)
+    await redis_client.publish(INVALIDATION_CHANNEL, session)
+
+
+async def listen_invalidations(redis_client: aioredis.Redis):
+    """
+    background task, applies invalidations published by other workers
+    """
+    while True:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            # messages sent while we were not subscribed are lost
+            verified_tokens.clear()
+            async for message in pubsub.listen():
+                verified_tokens.invalidate(message["data"].decode())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Token invalidation listener failed, resubscribing: ", e)
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
+        finally:
+            await pubsub.aclose()
@@ -0,0 +1,348 @@
+"""
+Token Store Module
+Redis layout for issued access tokens, rotation runs server-side in one round trip
+
+Layout, keyed by the token jti instead of the token itself:
+    t:<jti>                   -> user id, expires with the token
+    u:<user id // BUCKET>     hash, field <user id> -> "<jti>:<iat>:<exp>:<family>" of the
+                              user's current session, bucket expires with its newest session
+Small hashes are stored as listpacks, keep USER_BUCKET_SIZE below redis
+hash-max-listpack-entries (128 by default).
+
+The full JWT is never stored. When a user's current session is reused, the token is
+signed again from the stored jti/iat/exp, which gives back the same token. The same
+goes for refresh tokens, they are derived from the family and its generation.
+
+Tokens issued before this layout carry no jti. They are still stored as
+<token> -> user id and are resolved that way until they expire.
+TOKEN_LEGACY_FALLBACK=0 turns that lookup off once EXPIRE_TIME has passed since deploy.
+
+With several nodes in REDIS_NODES every user is owned by one node on a consistent
+hash ring (hash_ring.py), the session keys and bucket field of that user live there.
+Pub/sub is per server, so the scripts return revoked sessions and invalidations are
+published from here on the first node, the one every worker listens on.
+
+Refresh tokens are "<user id>.<family>.<generation>.<hmac>" strings, the user id only
+routes to the node. Every access session that is issued or rotated starts a family,
+logins that reuse the session get the family's current refresh token back:
+    f:<family>            hash user, name, scopes, generation,
+                          digest (sha256 of the current token)
+Using the current token of a family issues the next generation and deletes the access
+session it replaces. Presenting any other token of a live family means one of them
+leaked, the whole family and the user's access session are revoked. A family expires
+after REFRESH_TOKEN_TTL without use (sliding expiry), so Redis holds one hash per issued
+session no matter how often it is refreshed or how often the user logs in.
+The hmac key is REFRESH_TOKEN_SECRET, or SECRET when that is not set.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import redis.asyncio as aioredis
+from dotenv import load_dotenv
+
+from hash_ring import HashRing
+from metrics import TOKENS_ISSUED
+from token_cache import publish_invalidation
+
+load_dotenv()
+USER_BUCKET_SIZE = int(os.getenv("USER_BUCKET_SIZE", "100"))
+TOKEN_LEGACY_FALLBACK = os.getenv("TOKEN_LEGACY_FALLBACK", "1") == "1"
+JTI_BYTES = 12
+FAMILY_BYTES = 9
+REFRESH_TOKEN_SECRET = os.getenv("REFRESH_TOKEN_SECRET") or os.getenv("SECRET")
+
+# KEYS[1] user bucket, KEYS[2] session key of the candidate jti, KEYS[3] candidate refresh token family
+# ARGV: user id, candidate jti, iat, exp, expire, refresh threshold,
+#       candidate family, digest of its first refresh token, refresh ttl, name, scopes
+# keeps the current session while it has more than threshold seconds left, otherwise
+# stores the candidate, a family is only started along with a session
+# returns {"jti:iat:exp:family", REUSED | ISSUED, family, generation}
+#      or {"jti:iat:exp:family", ROTATED, family, generation, replaced jti}
+ISSUE_SCRIPT = """
+local function start_family()
+    redis.call('HSET', KEYS[3], 'user', ARGV[1], 'digest', ARGV[8], 'generation', '0',
+               'name', ARGV[10], 'scopes', ARGV[11])
+    redis.call('EXPIRE', KEYS[3], ARGV[9])
+end
+
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+local old_jti
+if current then
+    local family
+    old_jti, family = string.match(current, '^([^:]+):[^:]+:[^:]+:?([^:]*)$')
+    if redis.call('TTL', 't:' .. old_jti) >= tonumber(ARGV[6]) then
+        local generation = family ~= '' and redis.call('HGET', 'f:' .. family, 'generation')
+        if generation then
+            return {current, 0, family, generation}
+        end
+        -- sessions from before families, or whose family expired, get the candidate one
+        start_family()
+        current = string.match(current, '^[^:]+:[^:]+:[^:]+') .. ':' .. ARGV[7]
+        redis.call('HSET', KEYS[1], ARGV[1], current)
+        return {current, 0, ARGV[7], '0'}
+    end
+end
+start_family()
+local session = ARGV[2] .. ':' .. ARGV[3] .. ':' .. ARGV[4] .. ':' .. ARGV[7]
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[5])
+redis.call('HSET', KEYS[1], ARGV[1], session)
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+if old_jti then
+    return {session, 2, ARGV[7], '0', old_jti}
+end
+return {session, 1, ARGV[7], '0'}
+"""
+
+# KEYS[1] refresh token family, KEYS[2] user bucket, KEYS[3] session key of the new jti
+# ARGV: user id, presented refresh digest, new jti, iat, exp, expire,
+#       next refresh digest, next generation, refresh ttl, family
+# the replaced access session is deleted here, cached answers for it end with TOKEN_CACHE_TTL
+# returns {REFRESHED, name, scopes}, {UNKNOWN} or {REUSE_DETECTED[, revoked jti]}
+REFRESH_SCRIPT = """
+local entry = redis.call('HMGET', KEYS[1], 'user', 'digest', 'name', 'scopes')
+if not entry[1] or entry[1] ~= ARGV[1] then
+    return {0}
+end
+if entry[2] ~= ARGV[2] then
+    redis.call('DEL', KEYS[1])
+    local current = redis.call('HGET', KEYS[2], ARGV[1])
+    if current then
+        local jti = string.match(current, '^[^:]+')
+        redis.call('DEL', 't:' .. jti)
+        redis.call('HDEL', KEYS[2], ARGV[1])
+        return {2, jti}
+    end
+    return {2}
+end
+
+redis.call('HSET', KEYS[1], 'digest', ARGV[7], 'generation', ARGV[8])
+redis.call('EXPIRE', KEYS[1], ARGV[9])
+
+local current = redis.call('HGET', KEYS[2], ARGV[1])
+if current then
+    redis.call('DEL', 't:' .. string.match(current, '^[^:]+'))
+end
+local session = ARGV[3] .. ':' .. ARGV[4] .. ':' .. ARGV[5] .. ':' .. ARGV[10]
+redis.call('SET', KEYS[3], ARGV[1], 'EX', ARGV[6])
+redis.call('HSET', KEYS[2], ARGV[1], session)
+redis.call('EXPIRE', KEYS[2], ARGV[6])
+return {1, entry[3], entry[4]}
+"""
+REUSED, ISSUED, ROTATED = 0, 1, 2
+ISSUE_RESULTS = {
+    REUSED: TOKENS_ISSUED.labels("reused"),
+    ISSUED: TOKENS_ISSUED.labels("issued"),
+    ROTATED: TOKENS_ISSUED.labels("rotated"),
+}
+UNKNOWN, REFRESHED, REUSE_DETECTED = 0, 1, 2
+REFRESH_RESULTS = {
+    UNKNOWN: TOKENS_ISSUED.labels("refresh_unknown"),
+    REFRESHED: TOKENS_ISSUED.labels("refreshed"),
+    REUSE_DETECTED: TOKENS_ISSUED.labels("refresh_reuse_detected"),
+}
+
+
+def session_key(jti: str) -> str:
+    return f"t:{jti}"
+
+
+def bucket_key(user_id: int) -> str:
+    return f"u:{int(user_id) // USER_BUCKET_SIZE}"
+
+
+def family_key(family: str) -> str:
+    return f"f:{family}"
+
+
+def refresh_token_for(user_id: int, family: str, generation: int, secret: bytes) -> Tuple[str, str]:
+    """
+    (refresh token, digest stored in redis) of one generation of a family,
+    the same generation always gives the same token
+    """
+    claim = f"{user_id}.{family}.{generation}"
+    mac = hmac.new(secret, claim.encode(), hashlib.sha256).digest()
+    token = f"{claim}.{base64.urlsafe_b64encode(mac).decode().rstrip('=')}"
+    return token, hashlib.sha256(token.encode()).hexdigest()
+
+
+def parse_refresh_token(token: str) -> Optional[Tuple[int, str, int]]:
+    """
+    (user id, family, generation) a refresh token claims, None if malformed
+    """
+    parts = token.split(".")
+    if len(parts) != 4 or not parts[0].isdigit() or not parts[2].isdigit() or not parts[1] or not parts[3]:
+        return None
+    return int(parts[0]), parts[1], int(parts[2])
+
+
+class TokenStore:
+    """
+    sessions kept in redis with token lifetime as ttl, spread over redis nodes by user id
+    so that a user's bucket field and session keys always live on the same node
+
+    previous_ring is set while keys are being moved after a node change (see rebalance.py),
+    lookups that miss on the new owner then try the old one
+    """
+
+    def __init__(self, nodes: Dict[str, aioredis.Redis], ring: Optional[HashRing] = None,
+                 previous_ring: Optional[HashRing] = None, refresh_secret: Optional[str] = REFRESH_TOKEN_SECRET):
+        if not refresh_secret:
+            raise RuntimeError("REFRESH_TOKEN_SECRET or SECRET must be set")
+        self.refresh_secret = refresh_secret.encode()
+        # nodes may include ones only the previous ring still uses
+        self.nodes = nodes
+        self.ring = ring or HashRing(nodes)
+        self.previous_ring = previous_ring
+        # tokens issued before the jti layout only ever lived on the first node
+        self.legacy_node = self.ring.nodes[0]
+        # workers subscribe to invalidations on the first node only
+        self.pubsub = nodes[self.ring.nodes[0]]
+        self._issue = {name: client.register_script(ISSUE_SCRIPT) for name, client in nodes.items()}
+        self._refresh = {name: client.register_script(REFRESH_SCRIPT) for name, client in nodes.items()}
+
+    async def load_scripts(self):
+        """
+        load the lua scripts on every node ahead of the first EVALSHA
+        """
+        await asyncio.gather(*(
+            script.registered_client.script_load(script.script)
+            for scripts in (self._issue, self._refresh) for script in scripts.values()
+        ))
+
+    def locate(self, token: str, payload: dict) -> Optional[Tuple[str, str]]:
+        """
+        (node, key) holding the user id of a token, None if the token cannot be stored
+        """
+        jti = payload.get("jti")
+        if jti:
+            return self.ring.node_for(payload["user_id"]), session_key(jti)
+        if TOKEN_LEGACY_FALLBACK:
+            return self.legacy_node, token
+        return None
+
+    def _previous(self, payload: dict, located: Tuple[str, str]) -> Optional[Tuple[str, str]]:
+        """
+        where the key lived before the last node change, if that is somewhere else
+        """
+        if self.previous_ring is None or not payload.get("jti"):
+            return None
+        node = self.previous_ring.node_for(payload["user_id"])
+        if node == located[0]:
+            return None
+        return node, located[1]
+
+    async def issue(self, user_id: int, name: str, scopes: str, expire: int, threshold: int,
+                    refresh_ttl: int) -> Tuple[str, int, int, str]:
+        """
+        atomically keep the user's current session or start a new one with a new refresh
+        token family, returns (jti, iat, exp, current refresh token of the session's family)
+        """
+        iat = int(time.time())
+        jti = secrets.token_urlsafe(JTI_BYTES)
+        family = secrets.token_urlsafe(FAMILY_BYTES)
+        _, digest = refresh_token_for(user_id, family, 0, self.refresh_secret)
+        session, result, family, generation, *replaced = await self._issue[self.ring.node_for(user_id)](
+            keys=[bucket_key(user_id), session_key(jti), family_key(family)],
+            args=[
+                user_id, jti, iat, iat + expire, expire, threshold,
+                family, digest, refresh_ttl, name, scopes
+            ]
+        )
+        ISSUE_RESULTS[result].inc()
+        if replaced:
+            await publish_invalidation(self.pubsub, replaced[0].decode())
+        jti, iat, exp, _ = session.decode().split(":")
+        refresh_token, _ = refresh_token_for(user_id, family.decode(), int(generation), self.refresh_secret)
+        return jti, int(iat), int(exp), refresh_token
+
+    async def refresh(self, refresh_token: str, expire: int, refresh_ttl: int):
+        """
+        trade a refresh token for a new access session and the next refresh token,
+        returns (user_id, name, scopes, jti, iat, exp, next refresh token),
+        None if the token is unknown, expired or was already used
+        """
+        claimed = parse_refresh_token(refresh_token)
+        if claimed is None:
+            REFRESH_RESULTS[UNKNOWN].inc()
+            return None
+        user_id, family, generation = claimed
+        iat = int(time.time())
+        jti = secrets.token_urlsafe(JTI_BYTES)
+        next_token, next_digest = refresh_token_for(user_id, family, generation + 1, self.refresh_secret)
+        keys = [family_key(family), bucket_key(user_id), session_key(jti)]
+        args = [
+            user_id, hashlib.sha256(refresh_token.encode()).hexdigest(),
+            jti, iat, iat + expire, expire, next_digest, generation + 1, refresh_ttl, family
+        ]
+        node = self.ring.node_for(user_id)
+        reply = await self._refresh[node](keys=keys, args=args)
+        if reply[0] == UNKNOWN and self.previous_ring is not None:
+            # the family may not have been moved yet, it is refreshed where it is
+            previous = self.previous_ring.node_for(user_id)
+            if previous != node:
+                reply = await self._refresh[previous](keys=keys, args=args)
+        REFRESH_RESULTS[reply[0]].inc()
+        if reply[0] == REUSE_DETECTED and len(reply) > 1:
+            # revocation must not wait for TOKEN_CACHE_TTL
+            await publish_invalidation(self.pubsub, reply[1].decode())
+        if reply[0] != REFRESHED:
+            return None
+        return user_id, reply[1].decode(), reply[2].decode(), jti, iat, iat + expire, next_token
+
+    async def user_for(self, token: str, payload: dict) -> Optional[int]:
+        """
+        id of the user the token was issued to, None if unknown or expired
+        """
+        located = self.locate(token, payload)
+        if located is None:
+            return None
+        stored = await self.nodes[located[0]].get(located[1])
+        if not stored:
+            previous = self._previous(payload, located)
+            if previous is None:
+                return None
+            stored = await self.nodes[previous[0]].get(previous[1])
+            if not stored:
+                return None
+        return int(stored.decode())
+
+    async def users_for_many(self, tokens: List[Tuple[str, dict]]) -> List[Optional[int]]:
+        """
+        user_for() for many (token, payload) pairs with one MGET per node
+        """
+        located = [self.locate(token, payload) for token, payload in tokens]
+        values = await self._mget(located)
+        if self.previous_ring is not None:
+            retry = [
+                self._previous(payload, where) if where is not None and value is None else None
+                for (_, payload), where, value in zip(tokens, located, values)
+            ]
+            if any(retry):
+                for i, value in enumerate(await self._mget(retry)):
+                    if value is not None:
+                        values[i] = value
+        return [int(value.decode()) if value else None for value in values]
+
+    async def _mget(self, located: List[Optional[Tuple[str, str]]]) -> List[Optional[bytes]]:
+        """
+        values of (node, key) pairs, None entries are skipped, nodes are queried concurrently
+        """
+        by_node = defaultdict(list)
+        for i, where in enumerate(located):
+            if where is not None:
+                by_node[where[0]].append((i, where[1]))
+        replies = await asyncio.gather(*(
+            self.nodes[node].mget([key for _, key in entries]) for node, entries in by_node.items()
+        ))
+        values = [None] * len(located)
+        for entries, reply in zip(by_node.values(), replies):
+            for (i, _), value in zip(entries, reply):
+                values[i] = value
+        return values
@@ -0,0 +1,93 @@
+"""
+User Cache Module
+Read-through redis cache of user credential records in front of postgres
+"""
+import asyncio
+import json
+import os
+from typing import Awaitable, Callable, Iterable, Optional
+
+import redis.asyncio as aioredis
+
+from metrics import CACHE_REQUESTS
+
+# bump when the cached record layout changes, old entries are then ignored
+USER_CACHE_VERSION = os.getenv("USER_CACHE_VERSION", "1")
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "600"))
+# how long an unknown user id is remembered, 0 disables negative caching
+USER_CACHE_NEGATIVE_TTL = int(os.getenv("USER_CACHE_NEGATIVE_TTL", "5"))
+
+# cached value for user ids that do not exist
+MISSING = b""
+
+HITS = CACHE_REQUESTS.labels("user", "hit")
+NEGATIVE_HITS = CACHE_REQUESTS.labels("user", "negative_hit")
+MISSES = CACHE_REQUESTS.labels("user", "miss")
+
+
+class UserCache:
+    """
+    caches (id, password, name, scopes) per user id, loader is called on a miss
+    """
+
+    def __init__(self, redis_client: aioredis.Redis, loader: Callable[[int], Awaitable]):
+        self.redis = redis_client
+        self.loader = loader
+        # concurrent misses for the same id in this worker share one loader call
+        self._loading = {}
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        """
+        redis key of a user record
+        """
+        return f"user:v{USER_CACHE_VERSION}:{user_id}"
+
+    async def get(self, user_id: int) -> Optional[tuple]:
+        """
+        user record from cache, falling back to the loader on a miss
+        """
+        cached = await self.redis.get(self.key(user_id))
+        if cached == MISSING:
+            NEGATIVE_HITS.inc()
+            return None
+        if cached is not None:
+            HITS.inc()
+            return (user_id, *json.loads(cached))
+        MISSES.inc()
+
+        loading = self._loading.get(user_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(user_id))
+            self._loading[user_id] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(user_id, None))
+        return await asyncio.shield(loading)
+
+    async def _load(self, user_id: int) -> Optional[tuple]:
+        """
+        load a user and fill the cache
+        """
+        record = await self.loader(user_id)
+        if record is None:
+            if USER_CACHE_NEGATIVE_TTL > 0:
+                await self.redis.set(self.key(user_id), MISSING, ex=USER_CACHE_NEGATIVE_TTL)
+            return None
+        _, password, name, scopes = record
+        await self.redis.set(
+            self.key(user_id), json.dumps([password, name, scopes]), ex=USER_CACHE_TTL
+        )
+        return tuple(record)
+
+    async def invalidate(self, user_id: int):
+        """
+        forget a user, must be called whenever a user row changes or is created
+        """
+        await self.redis.delete(self.key(user_id))
+
+    async def invalidate_many(self, user_ids: Iterable[int]):
+        """
+        invalidate() for many users with a single DEL
+        """
+        keys = [self.key(user_id) for user_id in user_ids]
+        if keys:
+            await self.redis.delete(*keys)
@@ -0,0 +1,76 @@
+"""
+Verifier Module
+Offline token verification for other python services, keys come from the
+auth service JWKS endpoint and are cached
+
+    verifier = TokenVerifier("http://auth:8001/.well-known/jwks.json")
+    claims = verifier.verify(token)            # raises jwt.InvalidTokenError
+
+    # optionally reject tokens whose session expired, was replaced by a refresh
+    # or was revoked on refresh token reuse,
+    # pass every node of the auth service's REDIS_NODES in the same order
+    verifier = TokenVerifier(url, redis_nodes={
+        "auth-redis-1:6379": redis.Redis(host="auth-redis-1"),
+        "auth-redis-2:6379": redis.Redis(host="auth-redis-2"),
+    })
+"""
+from typing import Dict, Optional, Sequence
+
+import jwt
+
+from hash_ring import HashRing
+
+JWKS_CACHE_TTL = 300  # seconds
+
+
+class TokenVerifier:
+    """
+    verifies access tokens signed by the auth service without calling /check
+    """
+
+    def __init__(self, jwks_url: str, algorithms: Sequence[str] = ("EdDSA", "RS256"),
+                 redis_client=None, cache_ttl: int = JWKS_CACHE_TTL, redis_nodes: Optional[Dict] = None):
+        self.algorithms = list(algorithms)
+        # redis_client is a single node token store
+        if redis_nodes is None and redis_client is not None:
+            redis_nodes = {"default": redis_client}
+        self.nodes = redis_nodes
+        # same ring as TokenStore, so every user resolves to the node holding their sessions
+        self.ring = HashRing(redis_nodes) if redis_nodes else None
+        # refetches the key set on an unknown kid, so key rotation needs no restart
+        self.jwks_client = jwt.PyJWKClient(jwks_url, cache_jwk_set=True, lifespan=cache_ttl)
+
+    def verify(self, token: str) -> dict:
+        """
+        return token claims, raises jwt.InvalidTokenError if the token is not valid
+        or (with a redis client) no longer stored by the auth service
+        """
+        try:
+            signing_key = self.jwks_client.get_signing_key_from_jwt(token)
+        except jwt.PyJWKClientError as e:
+            raise jwt.InvalidTokenError(str(e)) from e
+        claims = jwt.decode(token, signing_key.key, algorithms=self.algorithms)
+        if self.ring is not None and not self._is_stored(token, claims):
+            raise jwt.InvalidTokenError("Token was revoked")
+        return claims
+
+    def scopes(self, token: str) -> Optional[str]:
+        """
+        scopes of an active token, None for any invalid token
+        """
+        try:
+            return self.verify(token).get("scopes")
+        except jwt.InvalidTokenError:
+            return None
+
+    def _is_stored(self, token: str, claims: dict) -> bool:
+        """
+        revocation check against the auth service token store
+        """
+        jti = claims.get("jti")
+        if jti:
+            stored = self.nodes[self.ring.node_for(claims.get("user_id"))].get(f"t:{jti}")
+        else:
+            # tokens without a jti only ever lived on the first node
+            stored = self.nodes[self.ring.nodes[0]].get(token)
+        return stored is not None and int(stored) == int(claims.get("user_id", -1))